@@ -1,12 +1,29 @@
+import copy
+import queue
+import threading
 import tkinter as tk
-from tkinter import filedialog, Text
-from KPI_Controller import ExcelDataReader, Data_Manager, Emission_Factor  # Assuming KPI_Controller.py is in the same directory
-from KPI_Controller import KPIs
+from tkinter import filedialog, ttk, Text
+from KPI_Controller import ExcelDataReader, Data_Manager, Emission_Factor, Emission_Factor_Registry  # Assuming KPI_Controller.py is in the same directory
+from KPI_Controller import KPIs, Sheet_Cache
+from KPI_Report import Run_Report, Profiler
 
 class AppInterface:
+    # Result tables shown below the totals: site subtotals or the rows of one category
+    table_views = {'Sites': None, 'Mobile fuel rows': 'mobile_fuel', 'Energy rows': 'energy',
+                   'Paper rows': 'paper', 'Water rows': 'water'}
+    page_rows = 20  # the table view only ever holds this many items; scrolling swaps their values
+
     def __init__(self, root):
         self.env_data = []
         self.emission_factor = None
+        self.sheet_cache = Sheet_Cache()
+        self.kpi = None
+        self.calculated = None  # Emission_Results of the last run
+        self.table = None
+        self.table_offset = 0
+        self.worker = None
+        self.cancel_event = None
+        self.messages = queue.Queue()
         self.root = root
         self.create_widgets()
 
@@ -36,11 +53,62 @@ class AppInterface:
         self.calculate_button = tk.Button(self.right_frame, text="Calculate", command=self.calculate)
         self.calculate_button.pack()
 
-        self.results = Text(self.left_frame)
-        self.results.pack()
+        self.cancel_button = tk.Button(self.right_frame, text="Cancel", command=self.cancel, state=tk.DISABLED)
+        self.cancel_button.pack()
+
+        self.progress = ttk.Progressbar(self.right_frame, mode='determinate', length=200)
+        self.progress.pack(pady=10)
+
+        self.status_label = tk.Label(self.right_frame, text="")
+        self.status_label.pack()
+
+        self.results = Text(self.left_frame, height=15)
+        self.results.pack(fill=tk.X)
+
+        self.table_controls = tk.Frame(self.left_frame)
+        self.table_controls.pack(fill=tk.X, pady=5)
+
+        self.table_choice = ttk.Combobox(self.table_controls, state='readonly', values=list(self.table_views), width=16)
+        self.table_choice.current(0)
+        self.table_choice.bind('<<ComboboxSelected>>', self.show_table)
+        self.table_choice.pack(side=tk.LEFT)
+
+        self.filter_label = tk.Label(self.table_controls, text="Filter:")
+        self.filter_label.pack(side=tk.LEFT, padx=(10, 0))
+
+        self.filter_entry = tk.Entry(self.table_controls, width=20)
+        self.filter_entry.bind('<Return>', self.filter_table)
+        self.filter_entry.pack(side=tk.LEFT)
+
+        self.filter_column = ttk.Combobox(self.table_controls, state='readonly', values=['All columns'], width=16)
+        self.filter_column.current(0)
+        self.filter_column.bind('<<ComboboxSelected>>', self.filter_table)
+        self.filter_column.pack(side=tk.LEFT)
+
+        self.export_xlsx_button = tk.Button(self.table_controls, text="Export xlsx", command=lambda: self.export_table('xlsx'))
+        self.export_xlsx_button.pack(side=tk.RIGHT)
+
+        self.export_csv_button = tk.Button(self.table_controls, text="Export CSV", command=lambda: self.export_table('csv'))
+        self.export_csv_button.pack(side=tk.RIGHT)
+
+        self.table_count = tk.Label(self.table_controls, text="")
+        self.table_count.pack(side=tk.RIGHT, padx=10)
+
+        self.table_frame = tk.Frame(self.left_frame)
+        self.table_frame.pack(fill=tk.BOTH, expand=True)
+
+        self.table_view = ttk.Treeview(self.table_frame, show='headings', height=self.page_rows, selectmode='browse')
+        self.table_view.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        for sequence in ('<MouseWheel>', '<Button-4>', '<Button-5>'):
+            self.table_view.bind(sequence, self.scroll_table_wheel)
+
+        self.table_scroll = ttk.Scrollbar(self.table_frame, orient=tk.VERTICAL, command=self.scroll_table)
+        self.table_scroll.pack(side=tk.RIGHT, fill=tk.Y)
 
     def browse_file(self):
         self.emission_factor = filedialog.askopenfilename(initialdir="/", title="Select file")
+        if self.emission_factor:
+            Emission_Factor_Registry.invalidate(self.emission_factor)  # Pick up edits to a re-selected factor file
         self.emission_factor_label['text'] = "Emission Factors: " + self.emission_factor
 
     def browse_files(self):
@@ -50,38 +118,235 @@ class AppInterface:
             self.file_list.insert(tk.END, file_path)
 
     def calculate(self):
+        if self.worker is not None and self.worker.is_alive():
+            return
         if not self.emission_factor or not self.env_data:
             self.results.delete('1.0', tk.END)
             self.results.insert(tk.END, 'Please select Emission Factors and Data Tables files.')
             return
 
-        kpi = KPIs(self.env_data, self.emission_factor)
-        total_area = kpi.calculate_total_area()
-
         self.results.delete('1.0', tk.END)
-        self.results.insert(tk.END, f"Total Area: {total_area:,.2f}")
-
-        MS_NOX_Total, MS_SOX_Total, MS_PM_Total, MS_CO2_Total, MS_CH4_Total, MS_N2O_Total = kpi.calculate_emissions_from_mobile_fuel()
-        self.results.insert(tk.END, f"\nA1 Air Emission from Mobile Source:")
-        self.results.insert(tk.END, f"\nNOx emission: {MS_NOX_Total/1000:,.2f} KG")
-        self.results.insert(tk.END, f"\nSOx emission: {MS_SOX_Total/1000:,.2f} KG")
-        self.results.insert(tk.END, f"\nPM emission: {MS_PM_Total/1000:,.2f} KG")
-        self.results.insert(tk.END, f"\nCO2 emission: {MS_CO2_Total/1000:,.2f} KG")
-        self.results.insert(tk.END, f"\nCH4 emission: {MS_CH4_Total/1000:,.2f} KG")
-        self.results.insert(tk.END, f"\nN2O emission: {MS_N2O_Total/1000:,.2f} KG")
-
-        EC_CO2_Total, Energy_Total = kpi.calculate_emissions_from_energy_consumption()
-        self.results.insert(tk.END, f"\nA2 Air Emission from Energy Consumption:")
-        self.results.insert(tk.END, f"\nCO2 emission: {EC_CO2_Total/1000:,.2f} KG")
-        self.results.insert(tk.END, f"\nTotal Energy: {Energy_Total/1000:,.2f} KG")
-
-        Paper_Total = kpi.calculate_emissions_from_paper_consumption()
-        self.results.insert(tk.END, f"\nB1 Emission from Paper Consumption:")
-        self.results.insert(tk.END, f"\nTotal Paper: {Paper_Total/1000:,.2f} KG")
-
-        Water_Total = kpi.calculate_emissions_from_water_consumption()
-        self.results.insert(tk.END, f"\nB2 Emission from Water Consumption:")
-        self.results.insert(tk.END, f"\nTotal Water: {Water_Total/1000:,.2f} m3")
+        self.results.insert(tk.END, "Per-site results:")
+        self.progress['maximum'] = len(self.env_data)
+        self.progress['value'] = 0
+        self.status_label['text'] = f"Loading 0 of {len(self.env_data)} files"
+        self.calculate_button['state'] = tk.DISABLED
+        self.cancel_button['state'] = tk.NORMAL
+
+        # Loading and calculation run on a worker thread; it reports back through self.messages,
+        # which the Tk main loop polls with after()
+        self.cancel_event = threading.Event()
+        self.messages = queue.Queue()
+        self.worker = threading.Thread(target=self.run_calculation, args=(list(self.env_data), self.emission_factor, self.cancel_event, self.messages), daemon=True)
+        self.worker.start()
+        self.root.after(100, self.poll_messages)
+
+    def cancel(self):
+        if self.cancel_event is not None:
+            self.cancel_event.set()
+            self.cancel_button['state'] = tk.DISABLED
+            self.status_label['text'] = "Cancelling..."
+
+    def run_calculation(self, file_paths, emission_factor, cancel, messages):
+        try:
+            # The KPIs instance is kept between runs, so only added or changed workbooks are reloaded
+            if self.kpi is None or self.kpi.emission_factor_file_path != emission_factor:
+                self.kpi = KPIs([], emission_factor, cache=self.sheet_cache)
+            kpi = self.kpi
+            kpi.report = Run_Report()  # Only covers what this run loads and calculates
+
+            def progress(done, total, file_path):
+                messages.put(('site', done, total, kpi.get_source_name(file_path), kpi.calculate_site(file_path)))
+
+            with Profiler() as profiler:
+                kpi.update_files(file_paths, progress=progress, cancel=cancel)
+                totals = {
+                    'area': kpi.calculate_total_area(),
+                    'mobile_fuel': kpi.calculate_emissions_from_mobile_fuel(),
+                    'energy': kpi.calculate_emissions_from_energy_consumption(),
+                    'paper': kpi.calculate_emissions_from_paper_consumption(),
+                    'water': kpi.calculate_emissions_from_water_consumption(),
+                }
+            kpi.report.profile = profiler.results
+            report = self.format_issues(kpi, kpi.validate()) + "\n\n" + kpi.report.format_text()
+            messages.put(('done', len(kpi.file_paths), len(file_paths), kpi.cancelled, totals, report))
+        except Exception as e:
+            messages.put(('error', str(e)))
+
+    def format_issues(self, kpi, issues, limit=50):
+        if issues.empty:
+            return "Data issues: none"
+        lines = [f"Data issues: {len(issues)}"]
+        for issue in issues.head(limit).itertuples(index=False):
+            location = " / ".join([kpi.get_source_name(issue.File)] + [part for part in (issue.Sheet, issue.Column) if isinstance(part, str)])
+            rows = f" (rows {', '.join(map(str, issue.Rows))})" if issue.Rows else ""
+            lines.append(f"{issue.Severity.upper()} {location}: {issue.Issue} x{issue.Count}{rows}")
+        if len(issues) > limit:
+            lines.append(f"... and {len(issues) - limit} more")
+        return "\n".join(lines)
+
+    def poll_messages(self):
+        try:
+            while True:
+                message = self.messages.get_nowait()
+                if message[0] == 'site':
+                    self.show_site(*message[1:])
+                elif message[0] == 'done':
+                    self.show_totals(*message[1:])
+                elif message[0] == 'exported':
+                    self.finish(f"Exported {message[1]:,} rows to {message[2]}")
+                else:
+                    self.finish(f"Error: {message[1]}")
+        except queue.Empty:
+            pass
+        if self.worker is not None and (self.worker.is_alive() or not self.messages.empty()):
+            self.root.after(100, self.poll_messages)
+
+    def finish(self, status):
+        self.status_label['text'] = status
+        self.calculate_button['state'] = tk.NORMAL
+        self.cancel_button['state'] = tk.DISABLED
+
+    def show_site(self, done, total, source_name, site):
+        self.progress['value'] = done
+        self.status_label['text'] = f"Loading {done} of {total} files"
+        mobile_co2 = site.total('mobile_fuel', 'CO2')
+        energy_co2 = site.total('energy', 'CO2')
+        self.results.insert(tk.END, f"\n{source_name}: CO2 {(mobile_co2 + energy_co2)/1000:,.2f} KG, "
+                                    f"Energy {site.total('energy', 'Energy'):,.2f} kWh, "
+                                    f"Water {site.total('water', 'Water'):,.2f} m3")
+        self.results.see(tk.END)
+
+    def show_totals(self, loaded, total, cancelled, totals, report):
+        lines = [""]
+        if cancelled:
+            lines.append(f"Cancelled: totals cover {loaded} of {total} files")
+        lines.append(f"Total Area: {totals['area']:,.2f}")
+
+        MS_NOX_Total, MS_SOX_Total, MS_PM_Total, MS_CO2_Total, MS_CH4_Total, MS_N2O_Total = totals['mobile_fuel']
+        lines.append("A1 Air Emission from Mobile Source:")
+        lines.append(f"NOx emission: {MS_NOX_Total/1000:,.2f} KG")
+        lines.append(f"SOx emission: {MS_SOX_Total/1000:,.2f} KG")
+        lines.append(f"PM emission: {MS_PM_Total/1000:,.2f} KG")
+        lines.append(f"CO2 emission: {MS_CO2_Total/1000:,.2f} KG")
+        lines.append(f"CH4 emission: {MS_CH4_Total/1000:,.2f} KG")
+        lines.append(f"N2O emission: {MS_N2O_Total/1000:,.2f} KG")
+
+        EC_CO2_Total, Energy_Total = totals['energy']
+        lines.append("A2 Air Emission from Energy Consumption:")
+        lines.append(f"CO2 emission: {EC_CO2_Total/1000:,.2f} KG")
+        lines.append(f"Total Energy: {Energy_Total/1000:,.2f} KG")
+
+        Paper_Total = totals['paper']
+        lines.append("B1 Emission from Paper Consumption:")
+        lines.append(f"Total Paper: {Paper_Total/1000:,.2f} KG")
+
+        Water_Total = totals['water']
+        lines.append("B2 Emission from Water Consumption:")
+        lines.append(f"Total Water: {Water_Total/1000:,.2f} m3")
+
+        lines.append("")
+        lines.append(report)
+        self.results.insert(tk.END, "\n" + "\n".join(lines))
+        self.results.see(tk.END)
+        self.calculated = self.kpi.calculate()  # memoized by the worker, so no recalculation
+        self.show_table()
+        self.finish("Cancelled" if cancelled else f"Done: {loaded} files")
+
+    def show_table(self, event=None):
+        if self.calculated is None:
+            return
+        category = self.table_views[self.table_choice.get()]
+        if category is not None and category not in self.calculated.rows:
+            return
+        source_names = [self.kpi.get_source_name(site) for site in self.calculated.sites]
+        self.table = self.calculated.get_table(category, source_names)
+        self.table_view['columns'] = self.table.names
+        for column in self.table.names:
+            self.table_view.heading(column, text=column, command=lambda column=column: self.sort_table(column))
+            self.table_view.column(column, width=110, stretch=False,
+                                   anchor=tk.E if self.table.columns[column].dtype.kind == 'f' else tk.W)
+        self.filter_column['values'] = ['All columns'] + self.table.names
+        self.filter_column.current(0)
+        self.filter_entry.delete(0, tk.END)
+        self.table_offset = 0
+        self.show_table_rows()
+
+    def show_table_rows(self):
+        # Only the visible window of the (sorted, filtered) view is formatted and inserted
+        total = len(self.table)
+        self.table_offset = max(0, min(self.table_offset, total - self.page_rows))
+        self.table_view.delete(*self.table_view.get_children())
+        for values in self.table.get_rows(self.table_offset, self.page_rows):
+            self.table_view.insert('', tk.END, values=values)
+        if total:
+            self.table_scroll.set(self.table_offset / total, min(1.0, (self.table_offset + self.page_rows) / total))
+        else:
+            self.table_scroll.set(0.0, 1.0)
+        self.table_count['text'] = f"{total:,} of {self.table.nrows:,} rows"
+
+    def scroll_table(self, *args):
+        # Scrollbar command: ('moveto', fraction) or ('scroll', count, 'units' | 'pages')
+        if self.table is None:
+            return
+        if args[0] == 'moveto':
+            self.table_offset = int(float(args[1]) * len(self.table))
+        elif args[0] == 'scroll':
+            self.table_offset += int(args[1]) * (self.page_rows if args[2] == 'pages' else 1)
+        self.show_table_rows()
+
+    def scroll_table_wheel(self, event):
+        step = -3 if event.num == 4 or getattr(event, 'delta', 0) > 0 else 3
+        self.scroll_table('scroll', step, 'units')
+        return 'break'
+
+    def sort_table(self, column):
+        if self.table is None:
+            return
+        descending = self.table.sort_column == column and not self.table.descending
+        self.table.sort(column, descending)
+        for name in self.table.names:
+            arrow = (" \u25bc" if descending else " \u25b2") if name == column else ""
+            self.table_view.heading(name, text=name + arrow)
+        self.table_offset = 0
+        self.show_table_rows()
+
+    def filter_table(self, event=None):
+        if self.table is None:
+            return
+        column = self.filter_column.get()
+        try:
+            self.table.filter(self.filter_entry.get(), None if column == 'All columns' else column)
+        except ValueError as e:
+            self.status_label['text'] = str(e)
+            return
+        self.table_offset = 0
+        self.show_table_rows()
+
+    def export_table(self, kind):
+        if self.table is None or (self.worker is not None and self.worker.is_alive()):
+            return
+        file_types = [("CSV files", "*.csv")] if kind == 'csv' else [("Excel files", "*.xlsx")]
+        file_path = filedialog.asksaveasfilename(title="Export table", defaultextension='.' + kind, filetypes=file_types)
+        if not file_path:
+            return
+        # The copy keeps the current view: sorting or filtering replaces the view, never changes it
+        self.messages = queue.Queue()
+        self.worker = threading.Thread(target=self.run_export, args=(copy.copy(self.table), kind, file_path, self.messages), daemon=True)
+        self.worker.start()
+        self.status_label['text'] = f"Exporting {len(self.table):,} rows..."
+        self.calculate_button['state'] = tk.DISABLED
+        self.root.after(100, self.poll_messages)
+
+    def run_export(self, table, kind, file_path, messages):
+        try:
+            if kind == 'csv':
+                table.to_csv(file_path)
+            else:
+                table.to_xlsx(file_path)
+            messages.put(('exported', len(table), file_path))
+        except Exception as e:
+            messages.put(('error', str(e)))
 
 if __name__ == "__main__":
     root = tk.Tk()
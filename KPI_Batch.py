@@ -0,0 +1,170 @@
+# Headless batch run: python KPI_Batch.py <emission factor xlsx> <dir | glob | xlsx>... [--json FILE] [--csv FILE]
+# Exit codes: 0 = success, 1 = data errors (unreadable workbooks, missing sheets/columns/factors), 2 = usage errors.
+# pandas / numpy are only imported once the arguments have been checked, and tkinter never is.
+import argparse
+import csv
+import glob
+import json
+import logging
+import math
+import os
+import sys
+import time
+
+start_time = time.perf_counter()
+
+def find_workbooks(inputs):
+    file_paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            file_paths.extend(sorted(glob.glob(os.path.join(item, 'Environmental_*.xlsx'))))
+        elif glob.has_magic(item):
+            file_paths.extend(sorted(glob.glob(item)))
+        else:
+            file_paths.append(item)
+    return [path for path in file_paths if not os.path.basename(path).startswith('~$')]  # skip Excel lock files
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Calculate ESG KPIs for a set of Environmental_<site>.xlsx workbooks.")
+    parser.add_argument('emission_factor', help="emission factor workbook (.xlsx)")
+    parser.add_argument('inputs', nargs='+', help="workbooks, directories containing Environmental_*.xlsx, or glob patterns")
+    parser.add_argument('--json', help="write totals and per-site results as JSON to this file ('-' for stdout)")
+    parser.add_argument('--csv', help="write one row of subtotals per site to this CSV file")
+    parser.add_argument('--workers', type=int, default=1, help="parse workbooks in this many processes")
+    parser.add_argument('--cache-dir', help="parsed-sheet cache directory (default ~/.esg_kpis_cache)")
+    parser.add_argument('--no-cache', action='store_true', help="always parse the workbooks")
+    parser.add_argument('--chunk-size', type=int, help="stream workbooks in chunks of this many rows (bounded memory)")
+    parser.add_argument('--categories', help="only read and calculate these categories, comma separated (area, mobile_fuel, energy, paper, water)")
+    parser.add_argument('--scenario', action='append', default=[], metavar='[NAME=]PATH',
+                        help="also evaluate mobile fuel and energy with this factor workbook (repeatable); adds a 'scenarios' "
+                             "comparison to the JSON. Unnamed scenarios are named after the file, numbered when names repeat")
+    parser.add_argument('--validate', nargs='?', const='', metavar='CSV',
+                        help="check every sheet for bad cells and unknown codes; adds an 'issues' list to the JSON and optionally writes it as CSV")
+    parser.add_argument('--period', help="add totals per reporting period (pandas frequency such as M, Q or Y) from the sheets' Date column")
+    parser.add_argument('--profile', default=os.environ.get('ESG_KPI_PROFILE', ''),
+                        help="'cprofile', 'tracemalloc' or both, comma separated (default $ESG_KPI_PROFILE)")
+    parser.add_argument('--report', help="write the run report (stage and site timings, messages, profile) as JSON to this file")
+    parser.add_argument('--verbose', action='store_true', help="log warnings and per-site subtotals to stderr")
+    return parser.parse_args(argv)
+
+def parse_scenario(value):
+    # 'NAME=PATH' or a plain path (an existing file whose name contains '=' is taken as a path)
+    if '=' in value and not os.path.isfile(value):
+        name, path = value.split('=', 1)
+        return name.strip(), path
+    return None, value
+
+def write_csv(path, site_table):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=list(site_table[0]) if site_table else ['File'])
+        writer.writeheader()
+        writer.writerows(site_table)
+
+def main(argv=None):
+    args = parse_args(argv)
+    file_paths = find_workbooks(args.inputs)
+    if not os.path.isfile(args.emission_factor):
+        print(f"Emission factor file not found: {args.emission_factor}", file=sys.stderr)
+        return 2
+    scenarios = [parse_scenario(value) for value in args.scenario]
+    for name, path in scenarios:
+        if not os.path.isfile(path):
+            print(f"Emission factor file not found: {path}", file=sys.stderr)
+            return 2
+    names = [name for name, _ in scenarios if name]
+    if len(set(names)) < len(names):
+        print(f"Duplicate scenario names: {', '.join(sorted({name for name in names if names.count(name) > 1}))}", file=sys.stderr)
+        return 2
+    if not file_paths:
+        print("No workbooks found", file=sys.stderr)
+        return 2
+
+    logging.basicConfig(stream=sys.stderr, level=logging.DEBUG if args.verbose else logging.CRITICAL, format="%(levelname)s %(message)s")
+    import_start = time.perf_counter()
+    from KPI_Controller import KPIs, Sheet_Cache, Emission_Scenarios
+    from KPI_Report import Profiler
+    timings = {'startup': import_start - start_time, 'import': time.perf_counter() - import_start}
+
+    categories = [category.strip() for category in args.categories.split(',')] if args.categories else None
+    with Profiler(args.profile) as profiler:
+        load_start = time.perf_counter()
+        cache = None if args.no_cache else Sheet_Cache(args.cache_dir)
+        try:
+            kpi = KPIs(file_paths, args.emission_factor, workers=args.workers, cache=cache, chunk_size=args.chunk_size,
+                       categories=categories)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            return 2
+        calculate_start = time.perf_counter()
+        results = kpi.calculate()
+        timings['load'] = calculate_start - load_start
+        timings['calculate'] = time.perf_counter() - calculate_start
+    kpi.report.profile = profiler.results
+    if args.verbose:
+        for category, log_subtotals in [('mobile_fuel', kpi.calculate_emissions_from_mobile_fuel),
+                                        ('energy', kpi.calculate_emissions_from_energy_consumption),
+                                        ('paper', kpi.calculate_emissions_from_paper_consumption),
+                                        ('water', kpi.calculate_emissions_from_water_consumption)]:
+            if category in kpi.categories:
+                log_subtotals()
+
+    site_table = [{'Site': kpi.get_source_name(row['File']), **row} for row in results.get_site_table()]
+    errors = [{'file': file_path, 'error': error} for file_path, error in kpi.load_errors.items()]
+    errors += [{'file': file_path, 'error': f"Missing sheets: {', '.join(sheets)}"} for file_path, sheets in kpi.missing_sheets.items()]
+    errors += [{'file': site, 'sheet': sheet, 'error': message} for site, sheet, message in results.errors]
+    report = {
+        'emission_factor': args.emission_factor,
+        'files': kpi.file_paths,
+        'totals': results.get_totals(),
+        'sites': site_table,
+        'errors': errors,
+        'timings': timings,
+        'stages': kpi.report.get_stage_summary(),
+    }
+
+    issues = None
+    if args.validate is not None:
+        issues = kpi.validate()
+        report['issues'] = issues.to_dict(orient='records')
+        if args.validate:
+            issues.assign(Rows=issues['Rows'].map(lambda rows: ' '.join(map(str, rows))),
+                          Values=issues['Values'].map('; '.join)).to_csv(args.validate, index=False, encoding='utf-8')
+
+    if args.period:
+        cube = kpi.get_cube(args.period)
+        report['periods'] = {period: {f"{category} {metric}": cube.total(category, metric, periods=[period])
+                                      for category, metric in cube.measures} for period in cube.periods}
+        intensities = {f"{category} {metric}": cube.intensity(category, metric, by=None) for category, metric in cube.measures}
+        report['intensity'] = {name: None if math.isnan(value) else value for name, value in intensities.items()}  # null without floor area
+
+    if scenarios:
+        # The main factor workbook is the first scenario; the others are compared against the same activity data
+        scenarios = [(None, args.emission_factor)] + scenarios
+        unnamed = Emission_Scenarios.get_scenario_names([path for name, path in scenarios if not name], taken=names)
+        factor_tables = {}
+        for name, path in scenarios:
+            factor_tables[name or unnamed.pop(0)] = path
+        scenarios = Emission_Scenarios(kpi).evaluate(factor_tables)
+        report['scenarios'] = scenarios.get_comparison_table().to_dict(orient='index')
+        report['scenario_errors'] = [{'scenario': name, 'file': site, 'sheet': sheet, 'error': message}
+                                     for name, site, sheet, message in scenarios.errors]
+
+    if args.report:
+        kpi.report.to_json(args.report)
+    if args.csv:
+        write_csv(args.csv, site_table)
+    if args.json and args.json != '-':
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False, allow_nan=False)
+    elif args.json == '-' or not args.csv:
+        json.dump(report, sys.stdout, indent=2, ensure_ascii=False, allow_nan=False)
+        print()
+    for error in errors:
+        print(f"{error['file']}: {error['error']}", file=sys.stderr)
+    if issues is not None and len(issues):
+        counts = issues.groupby('Severity')['Count'].sum()
+        print(f"Data issues: {', '.join(f'{count} {severity}s' for severity, count in counts.items())}", file=sys.stderr)
+    return 1 if errors or (issues is not None and (issues['Severity'] == 'error').any()) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,187 @@
+# Benchmark of the KPI pipeline on a synthetic portfolio:
+#   python KPI_Benchmark.py --sites 50 --rows 2000 --output bench.json [--baseline old.json] [--threshold 0.25]
+# Generates Environmental_<site>.xlsx workbooks (all five sheets) and a matching emission factor workbook,
+# times each stage (best of --repeat runs), records the tracemalloc peak of a full run and writes the
+# results as JSON. With --baseline, stages slower than the baseline by more than --threshold are
+# reported and the exit code is 1.
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+vehicle_types = ['Private Car', 'Light Goods Vehicle', 'Medium Goods Vehicle', 'Motorcycle']
+fuel_types = ['Unleaded Petrol', 'Diesel Oil', 'LPG']
+locations = ['Hong Kong', 'Shenzhen', 'Shanghai', 'Beijing', 'Singapore']
+
+def generate_emission_factors(file_path, rng):
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Emission_factors')
+    sheet.append(['Code', 'Emission Factor'])
+    source = '|Mobile Combustion Sources|'
+    for vehicle in vehicle_types:
+        sheet.append(['NOx Emission' + source + vehicle, rng.uniform(0.01, 1)])
+        sheet.append(['PM Emission' + source + vehicle, rng.uniform(0.001, 0.1)])
+    for fuel in fuel_types:
+        sheet.append(['SOx Emission' + source + fuel, rng.uniform(0.001, 0.01)])
+        sheet.append(['CO2 Emission' + source + fuel, rng.uniform(1.5, 3.2)])
+        for vehicle in vehicle_types:
+            sheet.append(['CH4 Emission' + source + vehicle + fuel, rng.uniform(0.0001, 0.001)])
+            sheet.append(['N2O Emission' + source + vehicle + fuel, rng.uniform(0.0001, 0.001)])
+    for location in locations:
+        sheet.append(['Purchased Electricity|' + location, rng.uniform(0.3, 0.9)])
+    workbook.save(file_path)
+
+def generate_site(file_path, site, rows, rng):
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Normalization_Factor')
+    sheet.append(['Site', 'Gross floor area'])
+    sheet.append(['', 'm2'])
+    sheet.append([site, rng.uniform(500, 50000)])
+    sheet = workbook.create_sheet('Mobile_Fuel')
+    sheet.append(['Transportation License #', 'Types of Transportation', 'Fuel Types', 'Fuel Consumption', 'Distance Travelled during the period/km'])
+    sheet.append(['', '', '', 'L', 'km'])
+    for i in range(rows):
+        sheet.append([f"{site}-{i:06d}", rng.choice(vehicle_types), rng.choice(fuel_types), rng.uniform(10, 2000), rng.uniform(100, 30000)])
+    sheet = workbook.create_sheet('Energy_Consumption')
+    sheet.append(['Location', 'Energy Consumption'])
+    sheet.append(['', 'kWh'])
+    for i in range(rows):
+        sheet.append([rng.choice(locations), rng.uniform(100, 10000)])
+    sheet = workbook.create_sheet('Paper_Usage')
+    sheet.append(['Usage (kg)'])
+    sheet.append(['kg'])
+    for i in range(rows):
+        sheet.append([rng.uniform(0.1, 50)])
+    sheet = workbook.create_sheet('Water_Consumption')
+    sheet.append(['Water Consumption'])
+    sheet.append(['m3'])
+    for i in range(rows):
+        sheet.append([rng.uniform(1, 500)])
+    workbook.save(file_path)
+
+def generate_portfolio(directory, sites, rows, seed=0):
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    emission_factor_file_path = os.path.join(directory, 'Emission_Factors.xlsx')
+    generate_emission_factors(emission_factor_file_path, rng)
+    file_paths = []
+    for i in range(sites):
+        file_path = os.path.join(directory, f"Environmental_Site{i:04d}.xlsx")
+        generate_site(file_path, f"Site{i:04d}", rows, rng)
+        file_paths.append(file_path)
+    return file_paths, emission_factor_file_path
+
+def run_pipeline(file_paths, emission_factor_file_path, workers):
+    # One full run; returns the duration of every stage in seconds
+    from KPI_Controller import KPIs, Emission_Calculator, Emission_Results, Emission_Factor_Registry
+    timings = {}
+    Emission_Factor_Registry.invalidate()
+    start = time.perf_counter()
+    emission_factor = Emission_Factor_Registry.get(emission_factor_file_path)
+    timings['factor_load'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    kpi = KPIs(file_paths, emission_factor_file_path, workers=workers)
+    timings['workbook_load'] = time.perf_counter() - start
+
+    # Each Emission_Calculator stage on its own; the public KPIs path is timed as a whole below
+    calculator = Emission_Calculator(emission_factor)
+    results = Emission_Results(kpi.file_paths)
+    for stage, method, data in [
+            ('calculate_area', calculator.calculate_area, kpi.normalization_factors),
+            ('calculate_mobile_fuel', calculator.calculate_mobile_fuel, kpi.mobile_fuel),
+            ('calculate_energy_consumption', calculator.calculate_energy_consumption, kpi.energy_consumption),
+            ('calculate_paper_consumption', calculator.calculate_paper_consumption, kpi.paper_consumption),
+            ('calculate_water_consumption', calculator.calculate_water_consumption, kpi.water_consumption)]:
+        start = time.perf_counter()
+        method(data, results)
+        timings[stage] = time.perf_counter() - start
+
+    Emission_Factor_Registry.invalidate()
+    start = time.perf_counter()
+    kpi = KPIs(file_paths, emission_factor_file_path, workers=workers)
+    kpi.calculate_total_area()
+    kpi.calculate_emissions_from_mobile_fuel()
+    kpi.calculate_emissions_from_energy_consumption()
+    kpi.calculate_emissions_from_paper_consumption()
+    kpi.calculate_emissions_from_water_consumption()
+    timings['total'] = time.perf_counter() - start
+    return timings
+
+def measure_peak_memory(file_paths, emission_factor_file_path):
+    from KPI_Controller import KPIs, Emission_Factor_Registry
+    Emission_Factor_Registry.invalidate()
+    tracemalloc.start()
+    try:
+        KPIs(file_paths, emission_factor_file_path).calculate()
+        return tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    finally:
+        tracemalloc.stop()
+
+def compare(results, baseline, threshold, min_delta=0.005):
+    # Stages faster than min_delta seconds are too noisy to compare by ratio alone
+    regressions = []
+    for stage, seconds in results['stages'].items():
+        previous = baseline.get('stages', {}).get(stage)
+        if previous and seconds > previous * (1 + threshold) and seconds - previous > min_delta:
+            regressions.append(f"{stage}: {seconds:.4f}s vs {previous:.4f}s baseline (+{seconds / previous - 1:.0%})")
+    previous = baseline.get('peak_memory_mb')
+    if previous and results['peak_memory_mb'] > previous * (1 + threshold):
+        regressions.append(f"peak_memory_mb: {results['peak_memory_mb']:.1f} vs {previous:.1f} baseline")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the KPI pipeline on a synthetic portfolio.")
+    parser.add_argument('--sites', type=int, default=20)
+    parser.add_argument('--rows', type=int, default=1000, help="rows per activity sheet")
+    parser.add_argument('--repeat', type=int, default=3, help="report the best of this many runs")
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', help="generate the workbooks here (and keep them) instead of in a temporary directory")
+    parser.add_argument('--output', default='bench_output.json')
+    parser.add_argument('--baseline', help="earlier --output file to compare against")
+    parser.add_argument('--threshold', type=float, default=0.25, help="allowed slowdown relative to the baseline")
+    parser.add_argument('--min-delta', type=float, default=0.005, help="ignore slowdowns smaller than this many seconds")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        directory = args.data_dir or temp_dir
+        file_paths, emission_factor_file_path = generate_portfolio(directory, args.sites, args.rows, args.seed)
+        runs = [run_pipeline(file_paths, emission_factor_file_path, args.workers) for _ in range(max(args.repeat, 1))]
+        peak_memory_mb = measure_peak_memory(file_paths, emission_factor_file_path)
+
+    import numpy
+    import pandas
+    results = {
+        'config': {'sites': args.sites, 'rows': args.rows, 'repeat': args.repeat, 'workers': args.workers, 'seed': args.seed},
+        'environment': {'python': platform.python_version(), 'pandas': pandas.__version__, 'numpy': numpy.__version__,
+                        'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'stages': {stage: min(run[stage] for run in runs) for stage in runs[0]},
+        'peak_memory_mb': peak_memory_mb,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    for stage, seconds in results['stages'].items():
+        print(f"{stage:45s} {seconds:9.4f} s")
+    print(f"{'peak memory':45s} {peak_memory_mb:9.1f} MB")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('config') != results['config']:
+            print("Warning: baseline was recorded with a different configuration", file=sys.stderr)
+        regressions = compare(results, baseline, args.threshold, args.min_delta)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
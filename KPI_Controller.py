@@ -1,5 +1,16 @@
 from typing import Optional
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import datetime
+import hashlib
+import logging
+import os
+import threading
+import time
+import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
+from KPI_Report import Run_Report, logger
 
 language = "EN" # CN=Chinese / EN=English
 nor_factor = "Gross floor area" # 可供出租面积(平方米) / Gross floor area
@@ -13,6 +24,7 @@ if language=="EN":
   energy_location_col_name = 'Location'
   paper_usage_col_name = 'Usage (kg)'
   water_consumption_col_name = 'Water Consumption'
+  date_col_name = 'Date'
 else:
   mobile_fuel_consumption_col_name = '燃料消耗值'
   mobile_mileage_col_name = '年內航行公里'
@@ -23,6 +35,17 @@ else:
   energy_location_col_name = '地區'
   paper_usage_col_name = '使用量(千克)'
   water_consumption_col_name = '水資源消耗'
+  date_col_name = '日期'
+
+mobile_fuel_emission_types = ["NOx Emission", "SOx Emission", "PM Emission", "CO2 Emission", "CH4 Emission", "N2O Emission"]
+
+# Defaults for the 'Parameters' sheet of the emission factor workbook (columns Parameter / Value).
+# 'Net Calorific Value|<fuel type>' overrides the calorific value for one fuel type.
+emission_parameters = {
+    'CH4 GWP': 28,
+    'N2O GWP': 256,
+    'Net Calorific Value': 9.11, # kWh/L for Unleaded Petrol
+}
 
 class ExcelDataReader:
     def __init__(self, file_id):
@@ -32,42 +55,455 @@ class ExcelDataReader:
         data = pd.read_excel(self.file_id, sheet_name=sheet_name, header=header_row)  # Modify this line
         return data
 
+    def read_sheets(self, sheet_names, header_row=0):
+        # Open the workbook once and parse every requested sheet from the same handle
+        with pd.ExcelFile(self.file_id) as workbook:
+            available = [name for name in sheet_names if name in workbook.sheet_names]
+            missing = [name for name in sheet_names if name not in workbook.sheet_names]
+            sheets = pd.read_excel(workbook, sheet_name=available, header=header_row) if available else {}
+        return sheets, missing
+
+    def iter_sheet_chunks(self, sheet_names, chunk_size=10000):
+        # Streaming alternative to read_sheets: walks each sheet with openpyxl's read-only row
+        # iterator and yields (sheet name, header, rows) with at most chunk_size rows at a time.
+        # Only the current chunk is held in memory. Missing sheets yield a single None header.
+        from openpyxl import load_workbook
+        workbook = load_workbook(self.file_id, read_only=True, data_only=True)
+        try:
+            for sheet_name in sheet_names:
+                if sheet_name not in workbook.sheetnames:
+                    yield sheet_name, None, []
+                    continue
+                rows = workbook[sheet_name].iter_rows(values_only=True)
+                header = next(rows, ())
+                chunk = []
+                for row in rows:
+                    chunk.append(row)
+                    if len(chunk) >= chunk_size:
+                        yield sheet_name, header, chunk
+                        chunk = []
+                yield sheet_name, header, chunk
+        finally:
+            workbook.close()
+
     def get_data(self):
         data = self.read_excel(self.data_path)
         return data
 
-class Data_Manager:
-    def __init__(self, file_id, sheet_name):
+class Workbook_Loader:
+    def __init__(self, file_id, sheet_names):
+        self.file_id = file_id
         self.data_reader = ExcelDataReader(file_id)
-        self.sheet_name = sheet_name
-        self.sheet = self.data_reader.read_excel(sheet_name=self.sheet_name)
-        self.populate_properties()
+        self.sheets, self.missing_sheets = self.data_reader.read_sheets(sheet_names)
 
-    def populate_properties(self):
-        ncols = len(self.sheet.columns)
-        for i in range(ncols):
-            column_name = self.sheet.columns[i]
-            if not self.sheet[column_name].isnull().all():
-                values = self.sheet[column_name].dropna().tolist()[1:]
-                setattr(self, str(column_name), values)  # Convert column_name to string
+    def get_sheet(self, sheet_name):
+        if sheet_name in self.sheets:
+            return self.sheets[sheet_name]
+        return pd.DataFrame()
 
-    def get_column_data(self, column_name):
-        if hasattr(self, column_name):
-            data = getattr(self, column_name)
-            return [float(x) if isinstance(x, (int, float)) and str(x) != 'nan' else (x if str(x) != 'nan' and str(x) != '' else None) for x in data]
+    def get_columns(self, sheet_name, numeric_columns=()):
+        return Sheet_Columns(self.get_sheet(sheet_name), numeric_columns)
+
+class Workbook_Columns:
+    # Parsed content of one workbook as compact column stores (no DataFrames), cheap to send
+    # back from a worker process. error is set when the workbook could not be read at all.
+    def __init__(self, file_id, columns, missing_sheets, error=None, timings=None):
+        self.file_id = file_id
+        self.columns = columns
+        self.missing_sheets = missing_sheets
+        self.error = error
+        self.timings = timings or {}  # seconds per loading stage, measured where the workbook was parsed
+
+    def count_rows(self):
+        return sum(columns.nrows for columns in self.columns.values())
+
+    def get_columns(self, sheet_name, numeric_columns=()):
+        if sheet_name in self.columns:
+            return self.columns[sheet_name]
+        return Sheet_Columns(pd.DataFrame(), numeric_columns)
+
+def load_workbook_columns(file_id, sheet_specs, cache=None, chunk_size=None):
+    # sheet_specs is a list of (sheet name, numeric columns, key columns). With a chunk_size the
+    # workbook is streamed and aggregated by key (see Sheet_Aggregator). Also runs in worker
+    # processes, so a failure is returned with the result instead of raised.
+    timings = {}
+    start = time.perf_counter()
+    try:
+        if chunk_size is not None:
+            return stream_workbook_columns(file_id, sheet_specs, chunk_size)
+        cached = {}
+        if cache is not None:
+            file_hash = cache.get_file_hash(file_id)
+            keys = {sheet_name: cache.get_key(file_hash, sheet_name, numeric_columns) for sheet_name, numeric_columns, _ in sheet_specs}
+            cached = {sheet_name: cache.load(key) for sheet_name, key in keys.items()}
+            timings['cache_read'] = time.perf_counter() - start
+        # Sheets (or the fact that they are missing) found in the cache are not parsed again
+        columns = {sheet_name: entry for sheet_name, entry in cached.items() if entry is not None and entry is not Sheet_Cache.missing}
+        missing = [sheet_name for sheet_name, entry in cached.items() if entry is Sheet_Cache.missing]
+        sheet_specs = [spec for spec in sheet_specs if cached.get(spec[0]) is None]
+        if not sheet_specs:
+            return Workbook_Columns(file_id, columns, missing, timings=timings)
+        start = time.perf_counter()
+        loader = Workbook_Loader(file_id, [sheet_name for sheet_name, _, _ in sheet_specs])
+        timings['sheet_read'] = time.perf_counter() - start
+        start = time.perf_counter()
+        columns.update((sheet_name, loader.get_columns(sheet_name, numeric_columns))
+                       for sheet_name, numeric_columns, _ in sheet_specs if sheet_name not in loader.missing_sheets)
+        timings['column_extraction'] = time.perf_counter() - start
+        if cache is not None:
+            start = time.perf_counter()
+            for sheet_name, _, _ in sheet_specs:
+                if not cache.save(keys[sheet_name], columns.get(sheet_name, Sheet_Cache.missing)):
+                    logger.warning(f"{file_id}: {sheet_name} is not cached and will be parsed on every run (cell types it cannot store)")
+            timings['cache_write'] = time.perf_counter() - start
+        return Workbook_Columns(file_id, columns, missing + loader.missing_sheets, timings=timings)
+    except Exception as e:
+        timings['sheet_read'] = timings.get('sheet_read', 0.0) + time.perf_counter() - start
+        return Workbook_Columns(file_id, {}, [], error=f"{type(e).__name__}: {e}", timings=timings)
+
+def stream_workbook_columns(file_id, sheet_specs, chunk_size):
+    specs = {sheet_name: (numeric_columns, key_columns) for sheet_name, numeric_columns, key_columns in sheet_specs}
+    aggregators = {}
+    missing = []
+    start = time.perf_counter()
+    for sheet_name, header, rows in ExcelDataReader(file_id).iter_sheet_chunks(list(specs), chunk_size):
+        if header is None:
+            missing.append(sheet_name)
+            continue
+        if sheet_name not in aggregators:
+            aggregators[sheet_name] = Sheet_Aggregator(header, *specs[sheet_name])
+        aggregators[sheet_name].add_chunk(rows)
+    timings = {'sheet_read': time.perf_counter() - start}
+    start = time.perf_counter()
+    columns = {sheet_name: aggregator.get_columns(specs[sheet_name][0]) for sheet_name, aggregator in aggregators.items()}
+    timings['column_extraction'] = time.perf_counter() - start
+    return Workbook_Columns(file_id, columns, missing, timings=timings)
+
+class Sheet_Cache:
+    # On-disk cache of parsed sheets, one .npz file of column arrays per sheet, keyed by the
+    # workbook content hash, the sheet name and the active language / column names. Hits
+    # refresh the file mtime and evict() deletes the least recently used files above max_bytes.
+    format_version = 3
+    missing = object()  # marker for a sheet the workbook does not have
+    category_kinds = {str: 'U', int: 'i', float: 'f', bool: 'b', pd.Timestamp: 'M', datetime.datetime: 'T',
+                      datetime.date: 'd', datetime.time: 't'}
+    category_parsers = {'U': str, 'i': int, 'f': float, 'b': lambda value: value == 'True', 'M': lambda value: pd.Timestamp(str(value)),
+                        'T': datetime.datetime.fromisoformat, 'd': datetime.date.fromisoformat, 't': datetime.time.fromisoformat}
+
+    def __init__(self, cache_dir=None, max_bytes=512 * 1024 * 1024):
+        if cache_dir is None:
+            cache_dir = os.environ.get('ESG_KPI_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.esg_kpis_cache'))
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get_file_hash(self, file_path):
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def get_key(self, file_hash, sheet_name, numeric_columns):
+        mapping = [language, nor_factor, mobile_fuel_consumption_col_name, mobile_mileage_col_name,
+                   mobile_fuel_id_col_name, mobile_fuel_code_col_name, mobile_fuel_type_col_name,
+                   energy_consumption_col_name, energy_location_col_name, paper_usage_col_name,
+                   water_consumption_col_name, date_col_name]
+        text = repr((self.format_version, file_hash, sheet_name, mapping, list(numeric_columns)))
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def load(self, key):
+        # None on a miss; an entry that cannot be read (truncated, corrupt, other layout) is
+        # deleted and counts as a miss, so the sheet is parsed and cached again
+        path = self.get_path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                arrays = {name: data[name] for name in data.files}
+            columns = self.get_columns(arrays)
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return columns
+
+    def get_columns(self, arrays):
+        if 'missing' in arrays:
+            return Sheet_Cache.missing
+        columns = Sheet_Columns(pd.DataFrame())
+        columns.nrows = int(arrays['nrows'])
+        columns.row_numbers = arrays.get('row_numbers')
+        for name in arrays['numeric']:
+            columns.invalid_masks[name] = arrays['invalid:' + name]
+            columns.add_numeric(name, arrays['values:' + name], arrays['nulls:' + name])
+        for name in arrays['text']:
+            categories = [self.category_parsers[kind](value) for value, kind in zip(arrays['categories:' + name], arrays['kinds:' + name])]
+            columns.add_text(name, pd.Categorical.from_codes(arrays['codes:' + name], categories))
+        return columns
+
+    def save(self, key, columns):
+        # False when the sheet has categories of a type that does not round-trip through strings
+        arrays = {}
+        if columns is Sheet_Cache.missing:
+            arrays['missing'] = np.ones(1, dtype=bool)
+        else:
+            arrays['nrows'] = np.array(columns.nrows)
+            if columns.row_numbers is not None:
+                arrays['row_numbers'] = columns.row_numbers
+            arrays['numeric'] = np.array(list(columns.numeric), dtype=str)
+            arrays['text'] = np.array(list(columns.text), dtype=str)
+            for name, values in columns.numeric.items():
+                arrays['values:' + name] = values
+                arrays['nulls:' + name] = columns.null_masks[name]
+                arrays['invalid:' + name] = columns.invalid_masks[name]
+            for name, values in columns.text.items():
+                kinds = [self.category_kinds.get(type(category)) for category in values.categories]
+                if None in kinds:
+                    return False
+                arrays['codes:' + name] = values.codes
+                arrays['categories:' + name] = np.array([category.isoformat() if kind in 'MTdt' else str(category)
+                                                         for category, kind in zip(values.categories, kinds)], dtype=str)
+                arrays['kinds:' + name] = np.array(kinds, dtype=str)
+        # Write to a temporary file and rename, so concurrent workers never see a partial entry
+        temp_path = f"{self.get_path(key)}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(temp_path, self.get_path(key))
+        return True
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npz'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npz'):
+                os.remove(entry.path)
+
+class Sheet_Columns:
+    # Row-aligned columnar copy of a sheet. The first row under the header holds units and is
+    # skipped, and fully blank rows are dropped, so every column has one entry per data row.
+    # Quantities become float64 arrays with nulls (and unreadable cells) filled with 0, other
+    # columns become categoricals; null_masks / invalid_masks record what was filled.
+    # row_numbers holds the Excel row of each entry (None when rows were aggregated).
+    def __init__(self, sheet, numeric_columns=()):
+        self.numeric = {}
+        self.text = {}
+        self.null_masks = {}
+        self.invalid_masks = {}
+        body = sheet.iloc[1:]
+        filled = body.notna().any(axis=1).to_numpy()
+        body = body[filled]
+        self.nrows = len(body)
+        self.row_numbers = np.arange(3, len(sheet) + 2)[filled]  # header and units are rows 1 and 2
+        for column in sheet.columns:
+            if sheet[column].isnull().all():
+                continue
+            name = str(column)
+            raw = body[column]
+            if name in numeric_columns:
+                values = pd.to_numeric(raw, errors='coerce').to_numpy(dtype=float)
+                nulls = raw.isna().to_numpy()
+                self.invalid_masks[name] = np.isnan(values) & ~nulls
+                self.add_numeric(name, np.nan_to_num(values, nan=0.0), nulls)
+            else:
+                raw = raw.where(raw.astype(str).str.strip() != '')
+                self.add_text(name, pd.Categorical(raw))
+
+    def add_numeric(self, name, values, nulls):
+        values.flags.writeable = False
+        nulls.flags.writeable = False
+        self.numeric[name] = values
+        self.null_masks[name] = nulls
+        self.invalid_masks.setdefault(name, np.zeros(len(values), dtype=bool))
+
+    def add_text(self, name, values):
+        self.text[name] = values
+        self.null_masks[name] = values.codes < 0
+
+    def has_column(self, name):
+        return name in self.numeric or name in self.text
+
+class Sheet_Aggregator:
+    # Running aggregate of a streamed sheet: numeric columns are summed per distinct combination of
+    # the key columns, so memory depends on the number of keys, not rows. get_columns() returns a
+    # Sheet_Columns with one row per key. The KPI formulas are linear in the quantities, so it
+    # yields the same subtotals as the row-level store (up to summation order).
+    def __init__(self, header, numeric_columns=(), key_columns=()):
+        self.names = [None if name is None else str(name) for name in header]
+        self.numeric = [i for i, name in enumerate(self.names) if name in numeric_columns]
+        self.keys = [i for i, name in enumerate(self.names) if name in key_columns]
+        self.seen = set()
+        self.sums = {}
+        self.units_row_pending = True
+
+    def add_chunk(self, rows):
+        if not rows or not self.names:
+            return
+        width = len(self.names)
+        frame = pd.DataFrame([tuple(row[:width]) + (None,) * (width - len(row)) for row in rows], columns=range(width))
+        self.seen.update(i for i in frame.columns if frame[i].notna().any())
+        if self.units_row_pending:
+            frame = frame.iloc[1:]  # units row under the header
+            self.units_row_pending = False
+        frame = frame[frame.notna().any(axis=1)]
+        if frame.empty:
+            return
+        values = np.column_stack([pd.to_numeric(frame[i], errors='coerce').fillna(0).to_numpy(dtype=float) for i in self.numeric]) \
+            if self.numeric else np.zeros((len(frame), 0))
+        if self.keys:
+            codes, uniques = self.get_keys(frame)
         else:
-            raise AttributeError(f"{column_name} not found in the {self.sheet_name}")
+            codes, uniques = np.zeros(len(frame), dtype=np.intp), [()]
+        sums = np.zeros((len(uniques), len(self.numeric)))
+        np.add.at(sums, codes, values)
+        for key, row in zip(uniques, sums):
+            if key in self.sums:
+                self.sums[key] += row
+            else:
+                self.sums[key] = row
+
+    def get_keys(self, frame):
+        # Codes of the distinct key tuples of the chunk and the tuples. Each column is factorized on
+        # its own and only its distinct values are cleaned: blank cells key as None and dates are
+        # truncated to the day, so intraday readings of a meter do not each make a key
+        codes = np.zeros(len(frame), dtype=np.int64)
+        levels = []
+        for i in self.keys:
+            column_codes, uniques = pd.factorize(frame[i].to_numpy(dtype=object))
+            uniques = [None if isinstance(value, str) and not value.strip() else value for value in uniques]
+            if self.names[i] == date_col_name:
+                uniques = [value.replace(hour=0, minute=0, second=0, microsecond=0)
+                           if isinstance(value, datetime.datetime) else value for value in uniques]
+            level_codes, level = pd.factorize(pd.Series(uniques, dtype=object))
+            column_codes = np.where(column_codes >= 0, level_codes[column_codes], -1)
+            codes, _ = pd.factorize(codes * (len(level) + 1) + column_codes + 1)
+            levels.append((level, column_codes))
+        _, first = np.unique(codes, return_index=True)
+        keys = [tuple(None if code < 0 else level[code] for (level, _), code in zip(levels, row))
+                for row in zip(*(column_codes[first] for _, column_codes in levels))]
+        return codes, keys
+
+    def get_columns(self, numeric_columns=()):
+        seen = [i for i in range(len(self.names)) if i in self.seen and self.names[i] is not None]
+        rows = [{self.names[i]: self.names[i] for i in seen}]  # stands in for the units row
+        for key, sums in self.sums.items():
+            row = {self.names[i]: None for i in seen}
+            row.update((self.names[i], value) for i, value in zip(self.keys, key))
+            row.update((self.names[i], value) for i, value in zip(self.numeric, sums))
+            rows.append(row)
+        columns = Sheet_Columns(pd.DataFrame(rows, columns=[self.names[i] for i in seen]), numeric_columns)
+        columns.row_numbers = None
+        return columns
+
+def concat_categories(left, right):
+    # Element-wise left + right for two categoricals; strings are only built for the distinct pairs
+    width = max(len(right.categories), 1)
+    valid = (left.codes >= 0) & (right.codes >= 0)
+    pairs = left.codes.astype(np.int64) * width + right.codes
+    uniques, inverse = np.unique(pairs[valid], return_inverse=True)
+    labels = np.array([str(left.categories[p // width]) + str(right.categories[p % width]) for p in uniques], dtype=object)
+    combined = np.full(len(valid), None, dtype=object)
+    combined[valid] = labels[inverse]
+    return combined
+
+class Data_Manager:
+    numeric_columns = []
+    key_columns = []  # text columns the calculation groups by; kept when a sheet is streamed
+    text_columns = []  # text columns the calculation needs
+
+    def __init__(self, file_id, sheet_name, loader=None):
+        # The sheet is only read (or taken from loader) the first time its columns are used
+        self.file_id = file_id
+        self.sheet_name = sheet_name
+        self.loader = loader
+        self.sheet_columns = None
+
+    @property
+    def columns(self):
+        if self.sheet_columns is None:
+            loader = self.loader if self.loader is not None else Workbook_Loader(self.file_id, [self.sheet_name])
+            self.sheet_columns = loader.get_columns(self.sheet_name, self.numeric_columns)
+            self.loader = None
+        return self.sheet_columns
+
+    def is_loaded(self):
+        return self.sheet_columns is not None
+
+    def has_column(self, column_name):
+        return self.columns.has_column(column_name)
 
+    def get_numeric_column(self, column_name):
+        if column_name in self.columns.numeric:
+            return self.columns.numeric[column_name]
+        raise AttributeError(f"{column_name} not found in the {self.sheet_name}")
+
+    def get_text_column(self, column_name):
+        if column_name in self.columns.text:
+            return self.columns.text[column_name]
+        raise AttributeError(f"{column_name} not found in the {self.sheet_name}")
+
+    def get_date_data(self):
+        # Row dates as datetime64 (NaT where the sheet has no date column or a cell is not a date)
+        if not self.has_column(date_col_name):
+            return np.full(self.columns.nrows, np.datetime64('NaT'), dtype='datetime64[ns]')
+        column = self.get_text_column(date_col_name)
+        categories = pd.to_datetime(pd.Series(np.asarray(column.categories, dtype=object)), errors='coerce')
+        dates = np.append(categories.to_numpy(dtype='datetime64[ns]'), np.datetime64('NaT'))
+        return dates[column.codes]  # code -1 (blank) picks the trailing NaT
+
+    def get_column_data(self, column_name):
+        if column_name in self.columns.numeric:
+            nulls = self.columns.null_masks[column_name] | self.columns.invalid_masks[column_name]
+            values = self.columns.numeric[column_name].astype(object)
+            values[nulls] = None
+            return values.tolist()
+        data = self.get_text_column(column_name)
+        # Classify the distinct values once; code -1 (blank) picks the trailing None
+        categories = [float(x) if isinstance(x, (int, float)) else x for x in data.categories] + [None]
+        return np.array(categories, dtype=object)[data.codes].tolist()
 
     def calculate_total(self, column_name):
-        if hasattr(self, column_name):
-            return sum(getattr(self, column_name))
+        if column_name in self.columns.numeric:
+            return float(self.columns.numeric[column_name].sum())
+        elif column_name in self.columns.text:
+            values = pd.to_numeric(np.asarray(self.columns.text[column_name], dtype=object), errors='coerce')
+            return float(np.nansum(values))
         else:
             return 0
 
+    def use_emission_factor(self, emission_factor):
+        # Accept either a shared Emission_Factor table or the path of the factor workbook
+        if not isinstance(emission_factor, Emission_Factor):
+            emission_factor = Emission_Factor_Registry.get(emission_factor)
+        self.emission_factor = emission_factor
+
     def get_emission_factor(self, emission_type, source_type, code):
       emission_code = emission_type + source_type + code
       return self.emission_factor.get_emission_factor(emission_code)
+
+    def get_emission_factors(self, emission_type, source_type, codes):
+      matrix, missing = self.emission_factor.get_emission_factor_matrix([emission_type], source_type, [codes])
+      return [None if m else float(f) for f, m in zip(matrix[:, 0], missing[:, 0])]
             
     def print_column_data(self, column_name):
         column_data = self.get_column_data(column_name)
@@ -75,288 +511,1200 @@ class Data_Manager:
 
 class Emission_Factor:
     sheet_name = 'Emission_factors'
+    parameter_sheet_name = 'Parameters'
 
     def __init__(self, file_path: str):
-        self.data_reader = pd.read_excel(file_path, sheet_name=self.sheet_name)
+        with pd.ExcelFile(file_path) as workbook:
+            self.data_reader = pd.read_excel(workbook, sheet_name=self.sheet_name)
+            self.parameters = dict(emission_parameters)
+            if self.parameter_sheet_name in workbook.sheet_names:
+                table = pd.read_excel(workbook, sheet_name=self.parameter_sheet_name)
+                values = pd.to_numeric(table['Value'], errors='coerce')
+                self.parameters.update((str(name), float(value)) for name, value in zip(table['Parameter'], values) if not np.isnan(value))
         self.data = self.data_reader.set_index('Code')
+        # Hash index over the factor codes for batch lookups (first occurrence wins on duplicates)
+        factors = self.data['Emission Factor']
+        factors = factors[~factors.index.duplicated(keep='first')]
+        self.codes = pd.Index(factors.index)
+        self.factors = pd.to_numeric(factors, errors='coerce').to_numpy(dtype=float)
+        self.factors.flags.writeable = False
 
     def get_emission_factor(self, code: str) -> Optional[float]:
         try:
             return float(self.data.loc[code, 'Emission Factor'])
         except KeyError:
             return None
+
+    def get_emission_factors(self, codes):
+        # Resolve a whole column of full codes at once; returns the factors and a mask of unresolved codes
+        positions = self.codes.get_indexer(pd.Index(codes, dtype=object))
+        values = np.where(positions >= 0, self.factors[positions], np.nan)
+        return values, np.isnan(values)
+
+    def get_emission_factor_matrix(self, emission_types, source_type, code_columns):
+        # One column of codes per emission type. Only the distinct codes of each column are
+        # turned into lookup keys, and all keys are resolved with a single indexer call.
+        nrows = len(code_columns[0]) if code_columns else 0
+        keys = []
+        inverses = []
+        for emission_type, column in zip(emission_types, code_columns):
+            if not isinstance(column, pd.Categorical):
+                column = np.asarray(column, dtype=object)
+            inverse, uniques = pd.factorize(column)
+            inverses.append((len(keys), inverse))
+            keys.extend(emission_type + source_type + str(code) for code in uniques)
+        values, _ = self.get_emission_factors(keys)
+        matrix = np.full((nrows, len(inverses)), np.nan)
+        for i, (offset, inverse) in enumerate(inverses):
+            found = inverse >= 0
+            matrix[found, i] = values[offset + inverse[found]]
+        return matrix, np.isnan(matrix)
+
+class Emission_Factor_Registry:
+    # One Emission_Factor table per factor workbook for the whole process. Tables are
+    # shared between data classes and never modified; an edited workbook (new mtime or
+    # size) or an explicit invalidate() replaces the table instead of mutating it.
+    _tables = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls, file_path: str) -> Emission_Factor:
+        path = os.path.abspath(file_path)
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        with cls._lock:
+            entry = cls._tables.get(path)
+            if entry is None or entry[0] != key:
+                entry = (key, Emission_Factor(path))
+                cls._tables[path] = entry
+            return entry[1]
+
+    @classmethod
+    def invalidate(cls, file_path: Optional[str] = None):
+        with cls._lock:
+            if file_path is None:
+                cls._tables.clear()
+            else:
+                cls._tables.pop(os.path.abspath(file_path), None)
         
 class Normalization_Factor(Data_Manager):
-    def __init__(self, file_id):
-        super().__init__(file_id, sheet_name='Normalization_Factor')
+    sheet_name = 'Normalization_Factor'
+    numeric_columns = [nor_factor]
+
+    def __init__(self, file_id, loader=None):
+        super().__init__(file_id, sheet_name=self.sheet_name, loader=loader)
 
     def calculate_area(self): 
         return self.calculate_total(nor_factor)
     
 class Mobile_Fuel(Data_Manager):
-    def __init__(self, file_id, emission_factor_file_path):
-        super().__init__(file_id, sheet_name='Mobile_Fuel')
-        self.file_id = file_id
-        self.emission_factor = Emission_Factor(emission_factor_file_path)
+    sheet_name = 'Mobile_Fuel'
+    numeric_columns = [mobile_fuel_consumption_col_name, mobile_mileage_col_name]
+    key_columns = [mobile_fuel_code_col_name, mobile_fuel_type_col_name, date_col_name]
+    text_columns = [mobile_fuel_id_col_name, mobile_fuel_code_col_name, mobile_fuel_type_col_name]
+
+    def __init__(self, file_id, emission_factor, loader=None):
+        super().__init__(file_id, sheet_name=self.sheet_name, loader=loader)
+        self.use_emission_factor(emission_factor)
 
     def calculate_mobile_fuel_consumption(self):
         return self.calculate_total(mobile_fuel_consumption_col_name)
 
     def get_mobile_fuel_data(self):
-        if hasattr(self, mobile_fuel_consumption_col_name):
-            data = self.get_column_data(mobile_fuel_consumption_col_name)
-            return [x if x is not None else 0 for x in data]
-        else:
-            raise AttributeError(f"{mobile_fuel_consumption_col_name} not found in the {self.sheet_name}")
+        return self.get_numeric_column(mobile_fuel_consumption_col_name)
     
     def get_mobile_mileage_data(self):
-        if hasattr(self, mobile_mileage_col_name):
-            data = self.get_column_data(mobile_mileage_col_name)
-            return [x if x is not None else 0 for x in data]
-        else:
-            raise AttributeError(f"{mobile_mileage_col_name} not found in the {self.sheet_name}")
+        return self.get_numeric_column(mobile_mileage_col_name)
 
     def get_mobile_fuel_id_data(self):
-        if hasattr(self, mobile_fuel_id_col_name):
-            data = self.get_column_data(mobile_fuel_id_col_name)
-            return [x if x is not None else "not found" for x in data]
-        else:
-            raise AttributeError(f"{mobile_fuel_id_col_name} not found in the {self.sheet_name}")
+        return self.get_text_column(mobile_fuel_id_col_name)
             
     def get_mobile_fuel_code_data(self):
-        if hasattr(self, mobile_fuel_code_col_name):
-            data = self.get_column_data(mobile_fuel_code_col_name)
-            return [x if x is not None else "not found" for x in data]
-        else:
-            raise AttributeError(f"{mobile_fuel_code_col_name} not found in the {self.sheet_name}")
+        return self.get_text_column(mobile_fuel_code_col_name)
 
     def get_mobile_fuel_type_data(self):
-        if hasattr(self, mobile_fuel_type_col_name):
-            data = self.get_column_data(mobile_fuel_type_col_name)
-            return [x if x is not None else "not found" for x in data]
-        else:
-            raise AttributeError(f"{mobile_fuel_type_col_name} not found in the {self.sheet_name}")
+        return self.get_text_column(mobile_fuel_type_col_name)
 
     def get_mobile_fuel_emission_factor(self, emission_type, code):
       return self.get_emission_factor(emission_type, "|Mobile Combustion Sources|", code)
 
     def get_mobile_fuel_emission_factors(self, emission_type, codes):
-      return [self.get_mobile_fuel_emission_factor(emission_type, code) for code in codes]
+      return self.get_emission_factors(emission_type, "|Mobile Combustion Sources|", codes)
+
+    def get_mobile_fuel_emission_factor_matrix(self):
+      # Rows x (NOx, SOx, PM, CO2, CH4, N2O) factors plus the mask of codes missing from the factor table
+      codes = self.get_mobile_fuel_code_data()
+      fuel_types = self.get_mobile_fuel_type_data()
+      combined = concat_categories(codes, fuel_types)
+      return self.emission_factor.get_emission_factor_matrix(
+          mobile_fuel_emission_types, "|Mobile Combustion Sources|",
+          [codes, fuel_types, codes, fuel_types, combined, combined])
     
 class Energy_Consumption(Data_Manager):
-    def __init__(self, file_id, emission_factor_file_path):
-        super().__init__(file_id, sheet_name='Energy_Consumption')
-        self.file_id = file_id
-        self.emission_factor = Emission_Factor(emission_factor_file_path)
+    sheet_name = 'Energy_Consumption'
+    numeric_columns = [energy_consumption_col_name]
+    key_columns = [energy_location_col_name, date_col_name]
+    text_columns = [energy_location_col_name]
+
+    def __init__(self, file_id, emission_factor, loader=None):
+        super().__init__(file_id, sheet_name=self.sheet_name, loader=loader)
+        self.use_emission_factor(emission_factor)
         
     def get_energy_data(self):
-        if hasattr(self, energy_consumption_col_name):
-            data = self.get_column_data(energy_consumption_col_name)
-            return [x if x is not None else 0 for x in data]
-        else:
-            raise AttributeError(f"{energy_consumption_col_name} not found in the {self.sheet_name}")
+        return self.get_numeric_column(energy_consumption_col_name)
 
     def get_location(self):
-        if hasattr(self, energy_location_col_name):
-            data = self.get_column_data(energy_location_col_name)
-            return [x if x is not None else "not found" for x in data]
-        else:
-            raise AttributeError(f"{energy_location_col_name} not found in the {self.sheet_name}")
+        return self.get_text_column(energy_location_col_name)
 
     def get_energy_consumption_emission_factor(self, emission_type, code):
       return self.get_emission_factor(emission_type, "|", code)
 
     def get_energy_consumption_emission_factors(self, emission_type, codes):
-      return [self.get_energy_consumption_emission_factor(emission_type, code) for code in codes]
+      return self.get_emission_factors(emission_type, "|", codes)
     
 class Paper_Consumption(Data_Manager):
-    def __init__(self, file_id, emission_factor_file_path):
-        super().__init__(file_id, sheet_name='Paper_Usage')
-        self.file_id = file_id
-        self.emission_factor = Emission_Factor(emission_factor_file_path)
+    sheet_name = 'Paper_Usage'
+    numeric_columns = [paper_usage_col_name]
+    key_columns = [date_col_name]
+
+    def __init__(self, file_id, emission_factor, loader=None):
+        super().__init__(file_id, sheet_name=self.sheet_name, loader=loader)
+        self.use_emission_factor(emission_factor)
         
     def get_paper_data(self):
-        if hasattr(self, paper_usage_col_name):
-            data = self.get_column_data(paper_usage_col_name)
-            return [x if x is not None else 0 for x in data]
-        else:
-            raise AttributeError(f"{paper_usage_col_name} not found in the {self.sheet_name}")
+        return self.get_numeric_column(paper_usage_col_name)
 
 class Water_Consumption(Data_Manager):
-    def __init__(self, file_id, emission_factor_file_path):
-        super().__init__(file_id, sheet_name='Water_Consumption')
-        self.file_id = file_id
-        self.emission_factor = Emission_Factor(emission_factor_file_path)
+    sheet_name = 'Water_Consumption'
+    numeric_columns = [water_consumption_col_name]
+    key_columns = [date_col_name]
+
+    def __init__(self, file_id, emission_factor, loader=None):
+        super().__init__(file_id, sheet_name=self.sheet_name, loader=loader)
+        self.use_emission_factor(emission_factor)
         
+    def get_water_data(self):
+        return self.get_numeric_column(water_consumption_col_name)
+
     def get_paper_data(self):
-        if hasattr(self, water_consumption_col_name):
-            data = self.get_column_data(water_consumption_col_name)
-            return [x if x is not None else 0 for x in data]
+        return self.get_water_data()
+
+# KPI categories (as in Emission_Results) and the data class of their sheet
+kpi_categories = {
+    'area': Normalization_Factor,
+    'mobile_fuel': Mobile_Fuel,
+    'energy': Energy_Consumption,
+    'paper': Paper_Consumption,
+    'water': Water_Consumption,
+}
+
+class Data_Validator:
+    # Bulk data-quality checks over every loaded sheet, separate from the calculation: each check is
+    # one array expression per sheet column (factor codes are resolved once per distinct value), and
+    # the findings of all sites come back together as one issue table. 'error' issues make the
+    # calculation leave a site or row out, 'warning' issues are counted as they are (0 for a
+    # non-numeric quantity). Streamed sheets are aggregated, so they have no row numbers and no
+    # non-numeric checks.
+    issue_columns = ['File', 'Sheet', 'Column', 'Severity', 'Issue', 'Count', 'Rows', 'Values']
+    max_examples = 10  # row numbers and values listed per issue
+
+    def __init__(self, emission_factor):
+        self.emission_factor = emission_factor
+        self.issues = []
+
+    def add_issue(self, file_id, sheet_name, column, severity, issue, mask=None, columns=None, values=None):
+        count = 1 if mask is None else int(np.count_nonzero(mask))
+        if count == 0:
+            return
+        rows, examples = [], []
+        if mask is not None:
+            positions = np.flatnonzero(mask)[:self.max_examples]
+            if columns.row_numbers is not None:
+                rows = columns.row_numbers[positions].tolist()
+            if values is not None:
+                examples = [str(value) for value in np.asarray(values, dtype=object)[positions]]
+        self.issues.append({'File': file_id, 'Sheet': sheet_name, 'Column': column, 'Severity': severity, 'Issue': issue,
+                            'Count': count, 'Rows': rows, 'Values': examples})
+
+    def get_report(self):
+        return pd.DataFrame(self.issues, columns=self.issue_columns)
+
+    def validate(self, data_managers):
+        for data_manager in data_managers:
+            self.validate_sheet(data_manager)
+        return self.get_report()
+
+    def validate_sheet(self, data_manager):
+        file_id, sheet_name = data_manager.file_id, data_manager.sheet_name
+        try:
+            columns = data_manager.columns
+        except Exception as e:
+            return self.add_issue(file_id, sheet_name, None, 'error', f"Unreadable sheet: {type(e).__name__}: {e}")
+        for name in data_manager.numeric_columns + data_manager.text_columns:
+            if not columns.has_column(name):
+                self.add_issue(file_id, sheet_name, name, 'error', "Missing column")
+        for name in data_manager.numeric_columns:
+            if name in columns.numeric:
+                values = columns.numeric[name]
+                self.add_issue(file_id, sheet_name, name, 'warning', "Non-numeric quantity", columns.invalid_masks[name], columns)
+                self.add_issue(file_id, sheet_name, name, 'warning', "Negative quantity", values < 0, columns, values)
+        # A streamed sheet only keeps its key columns; the other text columns are blank in its rows
+        text_columns = data_manager.text_columns if columns.row_numbers is not None else \
+            [name for name in data_manager.text_columns if name in data_manager.key_columns]
+        for name in text_columns:
+            if name in columns.text:
+                self.add_issue(file_id, sheet_name, name, 'error', "Missing value", columns.null_masks[name], columns)
+        if isinstance(data_manager, Mobile_Fuel) and columns.has_column(mobile_fuel_code_col_name) and columns.has_column(mobile_fuel_type_col_name):
+            self.validate_mobile_fuel_codes(data_manager, columns)
+        if isinstance(data_manager, Energy_Consumption) and columns.has_column(energy_location_col_name):
+            locations = columns.text[energy_location_col_name]
+            _, missing = self.emission_factor.get_emission_factor_matrix(["Purchased Electricity"], "|", [locations])
+            self.add_issue(data_manager.file_id, data_manager.sheet_name, energy_location_col_name, 'error',
+                           "Unknown location (no Purchased Electricity factor)", missing[:, 0] & (locations.codes >= 0), columns, locations)
+
+    def validate_mobile_fuel_codes(self, data_manager, columns):
+        # Transport types are checked against the NOx/PM factors, fuel types against SOx/CO2 and
+        # the pairs against CH4/N2O, so each bad cell is reported once under the right column
+        codes = columns.text[mobile_fuel_code_col_name]
+        fuel_types = columns.text[mobile_fuel_type_col_name]
+        combined = concat_categories(codes, fuel_types)
+        _, missing = self.emission_factor.get_emission_factor_matrix(
+            mobile_fuel_emission_types, "|Mobile Combustion Sources|",
+            [codes, fuel_types, codes, fuel_types, combined, combined])
+        known_code = ~(missing[:, 0] | missing[:, 2]) & (codes.codes >= 0)
+        known_fuel = ~(missing[:, 1] | missing[:, 3]) & (fuel_types.codes >= 0)
+        self.add_issue(data_manager.file_id, data_manager.sheet_name, mobile_fuel_code_col_name, 'error', "Unknown transport type",
+                       ~known_code & (codes.codes >= 0), columns, codes)
+        self.add_issue(data_manager.file_id, data_manager.sheet_name, mobile_fuel_type_col_name, 'error', "Unknown fuel type",
+                       ~known_fuel & (fuel_types.codes >= 0), columns, fuel_types)
+        self.add_issue(data_manager.file_id, data_manager.sheet_name, mobile_fuel_code_col_name, 'error',
+                       "Unknown transport and fuel type combination", known_code & known_fuel & (missing[:, 4] | missing[:, 5]),
+                       columns, combined)
+
+def stack_categoricals(columns):
+    try:
+        return union_categoricals(columns, ignore_order=True)
+    except TypeError:  # categories of different dtypes across sites
+        return pd.Categorical(np.concatenate([np.asarray(column, dtype=object) for column in columns]))
+
+class Emission_Results:
+    # Output of Emission_Calculator: per-site subtotals (site_totals[category][metric], one entry per
+    # site), the per-row arrays of every category (rows[category], 'Site' holds the site position)
+    # and the (site, sheet, message) errors of sites or rows left out of the totals.
+    def __init__(self, sites):
+        self.sites = list(sites)
+        self.site_totals = {}
+        self.rows = {}
+        self.errors = []
+
+    def add_rows(self, category, site_index, valid, columns, values):
+        rows = {'Site': site_index}
+        rows.update(columns)
+        self.site_totals[category] = {}
+        for metric, row_values in values.items():
+            self.site_totals[category][metric] = np.bincount(site_index[valid], weights=row_values[valid], minlength=len(self.sites))
+            rows[metric] = np.where(valid, row_values, np.nan)
+        self.rows[category] = rows
+
+    def total(self, category, metric):
+        return float(self.site_totals[category][metric].sum())
+
+    def get_errors(self, sheet_name):
+        return [(site, message) for site, sheet, message in self.errors if sheet == sheet_name]
+
+    def split(self):
+        # One single-site Emission_Results per site; rows are stored in site order, so each is a slice
+        parts = []
+        for i, site in enumerate(self.sites):
+            part = Emission_Results([site])
+            part.errors = [error for error in self.errors if error[0] == site]
+            for category, metrics in self.site_totals.items():
+                part.site_totals[category] = {metric: values[i:i + 1] for metric, values in metrics.items()}
+            for category, rows in self.rows.items():
+                start, end = np.searchsorted(rows['Site'], [i, i + 1])
+                part.rows[category] = {name: values[start:end] for name, values in rows.items()}
+                part.rows[category]['Site'] = np.zeros(end - start, dtype=np.intp)
+            parts.append(part)
+        return parts
+
+    @classmethod
+    def combine(cls, parts):
+        # Inverse of split(): concatenate the results of consecutive groups of sites
+        results = cls([site for part in parts for site in part.sites])
+        offsets = np.cumsum([0] + [len(part.sites) for part in parts])
+        for part in parts:
+            results.errors.extend(part.errors)
+        # Categories, metrics and row columns are the union over the parts; a part without one
+        # contributes zero subtotals and blank rows
+        for category in dict.fromkeys(category for part in parts for category in part.site_totals):
+            metrics = dict.fromkeys(metric for part in parts for metric in part.site_totals.get(category, {}))
+            results.site_totals[category] = {metric: np.concatenate([part.site_totals.get(category, {}).get(metric, np.zeros(len(part.sites)))
+                                                                     for part in parts])
+                                             for metric in metrics}
+        for category in dict.fromkeys(category for part in parts for category in part.rows):
+            results.rows[category] = {}
+            names = dict.fromkeys(name for part in parts for name in part.rows.get(category, {}))
+            template = {}
+            for part in parts:
+                for name, column in part.rows.get(category, {}).items():
+                    template.setdefault(name, column)
+            for name in names:
+                columns = [cls.get_row_column(part.rows.get(category, {}), name, template[name]) for part in parts]
+                if name == 'Site':
+                    results.rows[category][name] = np.concatenate([column + offset for column, offset in zip(columns, offsets)])
+                elif isinstance(columns[0], pd.Categorical):
+                    results.rows[category][name] = stack_categoricals(columns)
+                else:
+                    results.rows[category][name] = np.concatenate(columns)
+        return results
+
+    @staticmethod
+    def get_row_column(rows, name, template):
+        # Column name of rows, or a blank column shaped like template when rows lack it
+        if name in rows:
+            return rows[name]
+        nrows = len(rows['Site']) if 'Site' in rows else 0
+        if isinstance(template, pd.Categorical):
+            return pd.Categorical.from_codes(np.full(nrows, -1), template.categories[:0])
+        if np.issubdtype(template.dtype, np.datetime64):
+            return np.full(nrows, np.datetime64('NaT'), dtype=template.dtype)
+        if template.dtype.kind == 'f':
+            return np.full(nrows, np.nan)
+        return np.full(nrows, None, dtype=object)
+
+    def get_totals(self):
+        return {category: {metric: float(values.sum()) for metric, values in metrics.items()}
+                for category, metrics in self.site_totals.items()}
+
+    def get_site_table(self):
+        # One dict per site with a '<category> <metric>' entry for every subtotal
+        table = [{'File': site} for site in self.sites]
+        for category, metrics in self.site_totals.items():
+            for metric, values in metrics.items():
+                for row, value in zip(table, values.tolist()):
+                    row[f"{category} {metric}"] = value
+        return table
+
+    def get_table(self, category=None, site_names=None):
+        # Results_Table of the site subtotals, or of the rows of one category; site_names (one per
+        # site, e.g. the source names) label the Site column instead of the file paths
+        if site_names is None or len(set(site_names)) < len(site_names):
+            site_names = self.sites
+        site_names = pd.Index(site_names, dtype=object)
+        if category is None:
+            columns = {'Site': pd.Categorical.from_codes(np.arange(len(self.sites)), site_names)}
+            for name, metrics in self.site_totals.items():
+                columns.update((f"{name} {metric}", values) for metric, values in metrics.items())
         else:
-            raise AttributeError(f"{water_consumption_col_name} not found in the {self.sheet_name}")
-        
+            rows = self.rows[category]
+            columns = {'Site': pd.Categorical.from_codes(rows['Site'], site_names)}
+            columns.update((name, values) for name, values in rows.items() if name != 'Site')
+        return Results_Table(columns)
+
+class Results_Table:
+    # Sortable, filterable view over row-aligned result columns (numpy arrays and categoricals).
+    # The view is an index array into the columns, so rows are never materialized: get_rows()
+    # formats only the requested window and the exports write the view in chunks.
+    comparisons = {'<': np.less, '<=': np.less_equal, '>': np.greater, '>=': np.greater_equal, '=': np.equal}
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.names = list(columns)
+        self.nrows = len(next(iter(columns.values()))) if columns else 0
+        self.view = np.arange(self.nrows)
+        self.sort_column = None
+        self.descending = False
+        self.filter_text = ''
+        self.filter_column = None
+
+    def __len__(self):
+        return len(self.view)
+
+    def sort(self, column, descending=False):
+        self.sort_column = column
+        self.descending = descending
+        self.update_view()
+
+    def filter(self, text, column=None):
+        # Case-insensitive substring match on text and date columns; '<', '<=', '>', '>=' or '='
+        # followed by a number compares a numeric column. column=None matches any column, which
+        # is only allowed for text: a comparison over all columns would keep a row if any passed.
+        text = text.strip()
+        if column is None and self.get_comparison(text) is not None:
+            raise ValueError(f"Choose a column to filter by '{text}'")
+        self.filter_text = text
+        self.filter_column = column
+        self.update_view()
+
+    def get_comparison(self, text):
+        # (comparison function, number) of a filter like '>=100', None for other text
+        operator = text[:2] if text[:2] in self.comparisons else text[:1]
+        if operator not in self.comparisons:
+            return None
+        try:
+            return self.comparisons[operator], float(text[len(operator):])
+        except ValueError:
+            return None
+
+    def update_view(self):
+        rows = np.flatnonzero(self.get_filter_mask())
+        if self.sort_column is not None:
+            keys = self.get_sort_keys(self.sort_column)[rows]
+            order = np.argsort(-keys if self.descending else keys, kind='stable')  # blanks (NaN) sort last
+            rows = rows[order]
+        self.view = rows
+
+    def get_sort_keys(self, column):
+        values = self.columns[column]
+        if isinstance(values, pd.Categorical):
+            # Rank of every category in text order; blanks get NaN
+            ranks = np.empty(len(values.categories))
+            ranks[np.argsort(np.asarray(values.categories.astype(str), dtype=object))] = np.arange(len(values.categories))
+            return np.append(ranks, np.nan)[values.codes]
+        if np.issubdtype(values.dtype, np.datetime64):
+            return np.where(np.isnat(values), np.nan, values.astype('datetime64[s]').astype(np.int64).astype(float))
+        return values.astype(float)
+
+    def get_filter_mask(self):
+        if not self.filter_text:
+            return np.ones(self.nrows, dtype=bool)
+        mask = np.zeros(self.nrows, dtype=bool)
+        for column in [self.filter_column] if self.filter_column else self.names:
+            mask |= self.match(column, self.filter_text)
+        return mask
+
+    def match(self, column, text):
+        values = self.columns[column]
+        if isinstance(values, pd.Categorical):
+            hits = values.categories.astype(str).str.contains(text, case=False, regex=False)
+            return np.append(np.asarray(hits, dtype=bool), False)[values.codes]
+        if np.issubdtype(values.dtype, np.datetime64):
+            uniques, inverse = np.unique(values, return_inverse=True)
+            labels = pd.Series(np.datetime_as_string(uniques, unit='D'))
+            return (labels.str.contains(text, case=False, regex=False) & pd.Series(~np.isnat(uniques))).to_numpy()[inverse]
+        comparison = self.get_comparison(text)
+        if comparison is not None:
+            compare, number = comparison
+            return compare(values, number)
+        return np.zeros(self.nrows, dtype=bool)
+
+    def get_frame(self, start, stop):
+        rows = self.view[start:stop]
+        return pd.DataFrame({column: values[rows] for column, values in self.columns.items()}, columns=self.names)
+
+    def get_rows(self, start, count):
+        # Display strings of the view rows start .. start + count
+        frame = self.get_frame(start, start + count)
+        formatted = []
+        for column in self.names:
+            values = frame[column]
+            if isinstance(self.columns[column], pd.Categorical):
+                formatted.append(values.astype(object).where(values.notna(), '').astype(str))
+            elif np.issubdtype(self.columns[column].dtype, np.datetime64):
+                formatted.append(values.dt.strftime('%Y-%m-%d').fillna(''))
+            else:
+                formatted.append(values.map(lambda value: '' if np.isnan(value) else f"{value:,.2f}"))
+        return list(zip(*formatted))
+
+    def iter_frames(self, chunk_size=50000):
+        for start in range(0, len(self.view), chunk_size):
+            yield self.get_frame(start, start + chunk_size)
+
+    def to_csv(self, file_path, chunk_size=50000):
+        with open(file_path, 'w', newline='', encoding='utf-8') as f:
+            if not len(self.view):
+                pd.DataFrame(columns=self.names).to_csv(f, index=False)
+            for i, frame in enumerate(self.iter_frames(chunk_size)):
+                frame.to_csv(f, header=(i == 0), index=False)
+
+    def to_xlsx(self, file_path, chunk_size=50000, sheet_name='Results'):
+        # openpyxl's write-only mode streams the rows to disk, so memory stays at one chunk
+        from openpyxl import Workbook
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet(sheet_name)
+        sheet.append(self.names)
+        for frame in self.iter_frames(chunk_size):
+            frame = frame.astype(object).where(frame.notna(), None)
+            for row in frame.itertuples(index=False, name=None):
+                sheet.append(row)
+        workbook.save(file_path)
+
+class Results_Cube:
+    # Site x measure x period totals of one Emission_Results, built once per run so that roll-ups,
+    # slices and floor-area intensities are plain array reductions. A measure is a (category,
+    # metric) pair; the period of a row is its Date truncated to the pandas period frequency
+    # ('M', 'Q', 'Y', ...), and rows without a date fall in the 'Undated' period.
+    undated = 'Undated'
+
+    def __init__(self, results, period='M'):
+        self.results = results
+        self.period = period
+        self.sites = list(results.sites)
+        self.measures = [(category, metric) for category, metrics in results.site_totals.items() if category != 'area'
+                         for metric in metrics]
+        self.area = results.site_totals['area']['Area'] if 'area' in results.site_totals else None
+        period_labels = {}
+        for category in {category for category, _ in self.measures}:
+            period_labels[category] = self.get_period_labels(results.rows[category])
+        self.periods = sorted({label for labels, _ in period_labels.values() for label in labels} - {self.undated})
+        if any(self.undated in labels for labels, _ in period_labels.values()):
+            self.periods.append(self.undated)
+        self.site_positions = {site: i for i, site in enumerate(self.sites)}
+        self.measure_positions = {measure: i for i, measure in enumerate(self.measures)}
+        self.period_positions = {label: i for i, label in enumerate(self.periods)}
+        nsites, nperiods = len(self.sites), len(self.periods)
+        self.values = np.zeros((nsites, len(self.measures), nperiods))
+        for m, (category, metric) in enumerate(self.measures):
+            labels, inverse = period_labels[category]
+            periods = np.array([self.period_positions[label] for label in labels], dtype=np.intp)[inverse]
+            row_values = results.rows[category][metric]
+            valid = ~np.isnan(row_values)
+            cells = results.rows[category]['Site'][valid] * nperiods + periods[valid]
+            self.values[:, m, :] = np.bincount(cells, weights=row_values[valid], minlength=nsites * nperiods).reshape(nsites, nperiods)
+        self.values.flags.writeable = False
+
+    def get_period_labels(self, rows):
+        # Distinct period labels of a category and the label number of every row
+        if 'Date' not in rows:
+            return [self.undated], np.zeros(len(rows['Site']), dtype=np.intp)
+        inverse, dates = pd.factorize(rows['Date'], use_na_sentinel=False)
+        dates = pd.DatetimeIndex(dates)
+        labels = [self.undated if pd.isna(date) else str(label) for date, label in zip(dates, dates.to_period(self.period))]
+        return labels, inverse
+
+    def get_positions(self, positions, keys, kind):
+        if keys is None:
+            return slice(None)
+        if isinstance(keys, str) or isinstance(keys, tuple) and kind == 'measure':
+            keys = [keys]
+        try:
+            return [positions[key] for key in keys]
+        except KeyError as e:
+            raise KeyError(f"Unknown {kind}: {e.args[0]}") from None
+
+    def get_measures(self, category, metric):
+        measures = [measure for measure in self.measures if (category is None or measure[0] == category)
+                    and (metric is None or measure[1] == metric)]
+        if not measures and (category is not None or metric is not None):
+            raise KeyError(f"Unknown measure: {(category, metric)}")
+        return measures
+
+    def slice(self, category=None, metric=None, sites=None, periods=None):
+        # Sub-cube (sites x measures x periods) of the selected entries; None selects everything
+        measures = self.get_positions(self.measure_positions, self.get_measures(category, metric), 'measure')
+        values = self.values[self.get_positions(self.site_positions, sites, 'site')]
+        return values[:, measures][:, :, self.get_positions(self.period_positions, periods, 'period')]
+
+    def total(self, category, metric, sites=None, periods=None):
+        return float(self.slice(category, metric, sites, periods).sum())
+
+    def rollup(self, category, metric, by='site', sites=None, periods=None, groups=None):
+        # Totals of one measure per site, per period, or per group of sites (groups maps a site
+        # to a group name, e.g. its region); sites missing from groups are left out
+        measures = self.get_measures(category, metric)
+        if len(measures) != 1:
+            raise ValueError(f"Cannot roll up {len(measures)} measures, select one metric of {category}")
+        values = self.slice(*measures[0], sites, periods)[:, 0, :]
+        site_names = self.sites if sites is None else list(sites)
+        period_names = self.periods if periods is None else list(periods)
+        if by == 'site':
+            return pd.Series(values.sum(axis=1), index=pd.Index(site_names, name='Site'))
+        if by == 'period':
+            return pd.Series(values.sum(axis=0), index=pd.Index(period_names, name='Period'))
+        if by == 'group':
+            site_totals = pd.Series(values.sum(axis=1), index=site_names)
+            return site_totals.groupby(pd.Series(groups)).sum().rename_axis('Group')
+        raise ValueError(f"Cannot roll up by {by}")
+
+    def get_area(self, sites=None):
+        if self.area is None:
+            raise ValueError("Results have no floor area")
+        return self.area[self.get_positions(self.site_positions, sites, 'site')]
+
+    def intensity(self, category, metric, by='site', sites=None, periods=None, groups=None):
+        # Totals per m2 of Gross floor area: per site, per group of sites, per period (over the
+        # area of all selected sites) or, with by=None, one figure for the selection. It is NaN
+        # where the area is 0, e.g. for a site without a Normalization_Factor sheet.
+        area = pd.Series(self.get_area(sites), index=self.sites if sites is None else list(sites))
+        if by is None:
+            area = area.sum()
+            return self.total(category, metric, sites, periods) / area if area > 0 else np.nan
+        totals = self.rollup(category, metric, by, sites, periods, groups)
+        if by == 'site':
+            return totals / area.where(area > 0).to_numpy()
+        if by == 'group':
+            area = area.groupby(pd.Series(groups)).sum()
+            return totals / area.where(area > 0)
+        area = area.sum()
+        return totals / area if area > 0 else totals * np.nan
+
+    def to_frame(self):
+        # Long format (Site, Category, Metric, Period, Value) of the non-zero cells, e.g. for pivot tables
+        site, measure, period = np.nonzero(self.values)
+        return pd.DataFrame({
+            'Site': np.asarray(self.sites, dtype=object)[site],
+            'Category': np.asarray([category for category, _ in self.measures], dtype=object)[measure],
+            'Metric': np.asarray([metric for _, metric in self.measures], dtype=object)[measure],
+            'Period': np.asarray(self.periods, dtype=object)[period],
+            'Value': self.values[site, measure, period],
+        })
+
+class Emission_Calculator:
+    # Vectorized KPI computation over a whole portfolio. The rows of all sites are concatenated
+    # with a site index, each emission is a single array expression, and site subtotals come from
+    # np.bincount. GWPs and calorific values are taken from the factor workbook's parameter table.
+    # Totals agree with the former per-row loops to within 1e-9 relative; only the summation
+    # order differs. Sites whose sheet or columns are missing, or that have a vehicle without
+    # an emission factor, are left out of that category; energy rows without a factor are left
+    # out individually, as before, and counted in an error of their site.
+    def __init__(self, emission_factor, parameters=None, report=None):
+        self.emission_factor = emission_factor
+        self.parameters = dict(emission_factor.parameters)
+        if parameters:
+            self.parameters.update(parameters)
+        self.report = report if report is not None else Run_Report()
+
+    def calculate(self, sites, normalization_factors, mobile_fuel, energy_consumption, paper_consumption, water_consumption,
+                  categories=None):
+        # categories limits the calculation to some of kpi_categories; the sheets of the others are not touched
+        results = Emission_Results(sites)
+        for category, calculate, data in [('area', self.calculate_area, normalization_factors),
+                                          ('mobile_fuel', self.calculate_mobile_fuel, mobile_fuel),
+                                          ('energy', self.calculate_energy_consumption, energy_consumption),
+                                          ('paper', self.calculate_paper_consumption, paper_consumption),
+                                          ('water', self.calculate_water_consumption, water_consumption)]:
+            if categories is None or category in categories:
+                calculate(data, results)
+        for site, sheet_name, message in results.errors:
+            self.report.log(logging.WARNING, f"{sheet_name}: {message}", site=site, stage='computation')
+        return results
+
+    def stack(self, data_managers, results, get_columns, empty):
+        # empty holds zero-length columns of the right types, used when no site has readable columns,
+        # so every result has the same row columns whatever its sites
+        with self.report.stage('column_stacking') as record:
+            site_index, columns = self.stack_columns(data_managers, results, get_columns)
+            record['rows'] = len(site_index)
+        return site_index, empty if columns is None else columns
+
+    def stack_columns(self, data_managers, results, get_columns):
+        # Concatenate the columns of every site; a site whose columns cannot be read is reported and skipped.
+        # None stands for a sheet that was reported as unreadable or missing when it was loaded.
+        site_index = []
+        columns = []
+        for i, data_manager in enumerate(data_managers):
+            if data_manager is None:
+                continue
+            try:
+                site_columns = get_columns(data_manager)
+            except Exception as e:
+                results.errors.append((results.sites[i], data_manager.sheet_name, str(e)))
+                continue
+            columns.append(site_columns)
+            site_index.append(np.full(len(site_columns[0]), i, dtype=np.intp))
+        if not columns:
+            return np.zeros(0, dtype=np.intp), None
+        stacked = []
+        for parts in zip(*columns):
+            if isinstance(parts[0], pd.Categorical):
+                stacked.append(stack_categoricals(parts))
+            else:
+                stacked.append(np.concatenate(parts))
+        return np.concatenate(site_index), stacked
+
+    def add_row_errors(self, results, sheet_name, site_index, bad_rows, message):
+        # One error per site with bad rows, message formatted with their count; returns those sites
+        bad_sites = np.unique(site_index[bad_rows])
+        for i in bad_sites:
+            count = int(np.count_nonzero(bad_rows & (site_index == i)))
+            results.errors.append((results.sites[i], sheet_name, message.format(count=count)))
+        return bad_sites
+
+    def drop_sites(self, results, sheet_name, site_index, bad_rows, message):
+        return ~np.isin(site_index, self.add_row_errors(results, sheet_name, site_index, bad_rows, message))
+
+    def get_parameter_column(self, name, column):
+        # Per-row parameter value, allowing a '<name>|<value>' override for each distinct value of column
+        inverse, uniques = pd.factorize(column)
+        default = self.parameters[name]
+        values = np.array([self.parameters.get(f"{name}|{u}", default) for u in uniques] + [default], dtype=float)
+        return values[inverse]
+
+    def get_empty_columns(self, kinds):
+        # Zero-length column per kind: 'text' (categorical), 'number' or 'date'
+        empty = {'text': lambda: pd.Categorical([]), 'number': lambda: np.zeros(0),
+                 'date': lambda: np.zeros(0, dtype='datetime64[ns]')}
+        return [empty[kind]() for kind in kinds]
+
+    def calculate_area(self, normalization_factors, results):
+        site_index, columns = self.stack(normalization_factors, results, lambda nf: (
+            nf.get_numeric_column(nor_factor) if nf.has_column(nor_factor) else np.zeros(0),),
+            self.get_empty_columns(['number']))
+        area, = columns
+        with self.report.stage('computation', rows=len(area)):
+            results.add_rows('area', site_index, np.ones(len(area), dtype=bool), {}, {'Area': area})
+
+    def calculate_mobile_fuel(self, mobile_fuel, results):
+        site_index, columns = self.stack(mobile_fuel, results, lambda mf: (
+            mf.get_mobile_fuel_id_data(), mf.get_mobile_fuel_code_data(), mf.get_mobile_fuel_type_data(),
+            mf.get_mobile_fuel_data(), mf.get_mobile_mileage_data(), mf.get_date_data()),
+            self.get_empty_columns(['text', 'text', 'text', 'number', 'number', 'date']))
+        ids, codes, fuel_types, fuel, mileage, dates = columns
+        with self.report.stage('factor_lookup', rows=len(site_index)):
+            combined = concat_categories(codes, fuel_types)
+            factors, missing = self.emission_factor.get_emission_factor_matrix(
+                mobile_fuel_emission_types, "|Mobile Combustion Sources|",
+                [codes, fuel_types, codes, fuel_types, combined, combined])
+        with self.report.stage('computation', rows=len(site_index)):
+            valid = self.drop_sites(results, Mobile_Fuel.sheet_name, site_index, missing.any(axis=1),
+                                    "No emission factor for {count} vehicle entries")
+            NOX_ef, SOX_ef, PM_ef, CO2_ef, CH4_ef, N2O_ef = factors.T
+            values = {
+                'Fuel kWh': fuel * self.get_parameter_column('Net Calorific Value', fuel_types),
+                'NOx': mileage * NOX_ef,
+                'SOx': fuel * SOX_ef,
+                'PM': mileage * PM_ef,
+                'CO2': fuel * CO2_ef,
+                'CH4': fuel * CH4_ef * self.parameters['CH4 GWP'],
+                'N2O': fuel * N2O_ef * self.parameters['N2O GWP'],
+            }
+            columns = {'ID': ids, 'Type': codes, 'Fuel Type': fuel_types, 'Consumption': fuel, 'Mileage': mileage, 'Date': dates}
+            results.add_rows('mobile_fuel', site_index, valid, columns, values)
+
+    def calculate_energy_consumption(self, energy_consumption, results):
+        site_index, columns = self.stack(energy_consumption, results, lambda ec: (ec.get_location(), ec.get_energy_data(), ec.get_date_data()),
+                                           self.get_empty_columns(['text', 'number', 'date']))
+        locations, energy, dates = columns
+        with self.report.stage('factor_lookup', rows=len(site_index)):
+            factors, missing = self.emission_factor.get_emission_factor_matrix(["Purchased Electricity"], "|", [locations])
+        with self.report.stage('computation', rows=len(site_index)):
+            valid = ~missing[:, 0]
+            self.add_row_errors(results, Energy_Consumption.sheet_name, site_index, ~valid, "No emission factor for {count} energy rows")
+            values = {'CO2': energy * factors[:, 0], 'Energy': energy}
+            results.add_rows('energy', site_index, valid, {'Location': locations, 'Consumption': energy, 'Date': dates}, values)
+
+    def calculate_paper_consumption(self, paper_consumption, results):
+        site_index, columns = self.stack(paper_consumption, results, lambda pc: (pc.get_paper_data(), pc.get_date_data()),
+                                           self.get_empty_columns(['number', 'date']))
+        paper, dates = columns
+        with self.report.stage('computation', rows=len(paper)):
+            results.add_rows('paper', site_index, np.ones(len(paper), dtype=bool), {'Date': dates}, {'Paper': paper / 1000}) # data is in gram
+
+    def calculate_water_consumption(self, water_consumption, results):
+        site_index, columns = self.stack(water_consumption, results, lambda wc: (wc.get_water_data(), wc.get_date_data()),
+                                           self.get_empty_columns(['number', 'date']))
+        water, dates = columns
+        with self.report.stage('computation', rows=len(water)):
+            results.add_rows('water', site_index, np.ones(len(water), dtype=bool), {'Date': dates}, {'Water': water}) # data is in m3
+
 class KPIs:
-    def __init__(self, file_paths, emission_factor_file_path):
-        self.file_paths = file_paths
-        self.normalization_factors = [Normalization_Factor(file_path) for file_path in file_paths]
-        self.mobile_fuel = [Mobile_Fuel(file_path, emission_factor_file_path) for file_path in file_paths]
-        self.energy_consumption = [Energy_Consumption(file_path, emission_factor_file_path) for file_path in file_paths]
-        self.paper_consumption = [Paper_Consumption(file_path, emission_factor_file_path) for file_path in file_paths]
-        self.water_consumption = [Water_Consumption(file_path, emission_factor_file_path) for file_path in file_paths]
+    def __init__(self, file_paths, emission_factor_file_path, parameters=None, workers=1, cache=None, progress=None, cancel=None,
+                 chunk_size=None, report=None, categories=None):
+        self.file_paths = []
+        self.emission_factor_file_path = emission_factor_file_path
+        self.emission_factor = Emission_Factor_Registry.get(emission_factor_file_path)
+        self.parameters = parameters
+        self.workers = workers
+        self.cache = cache
+        self.chunk_size = chunk_size  # set to stream workbooks with bounded memory (no row-level results)
+        self.report = report if report is not None else Run_Report()
+        # Only the sheets of these categories are read up front; the others are read by
+        # add_categories() when one of their totals is first asked for
+        if categories is not None and not set(categories) <= set(kpi_categories):
+            raise ValueError(f"Unknown KPI categories: {', '.join(sorted(set(categories) - set(kpi_categories)))}")
+        self.categories = list(kpi_categories) if categories is None else [c for c in kpi_categories if c in categories]
+        self.results = None
+        self.cancelled = False
+        self.normalization_factors = []
+        self.mobile_fuel = []
+        self.energy_consumption = []
+        self.paper_consumption = []
+        self.water_consumption = []
+        self.missing_sheets = {}
+        self.load_errors = {}
+        self.file_identities = {}
+        self.site_results = {}  # memoized single-site Emission_Results by file path
+        self.cube = None
+        self.load_files(file_paths, progress, cancel)
+
+    def get_file_identity(self, file_path):
+        try:
+            stat = os.stat(file_path)
+            return stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
+
+    def get_data_lists(self):
+        return [self.normalization_factors, self.mobile_fuel, self.energy_consumption, self.paper_consumption, self.water_consumption]
+
+    def update_files(self, file_paths, progress=None, cancel=None):
+        # Bring the loaded portfolio in line with file_paths: only new or changed workbooks (by
+        # mtime and size) are loaded and recalculated, removed ones are dropped, and the other
+        # sites keep their memoized subtotals. A changed factor workbook invalidates all subtotals.
+        file_paths = list(dict.fromkeys(file_paths))
+        emission_factor = Emission_Factor_Registry.get(self.emission_factor_file_path)
+        if emission_factor is not self.emission_factor:
+            self.emission_factor = emission_factor
+            self.site_results.clear()
+            for data_list in self.get_data_lists()[1:]:
+                for data_manager in data_list:
+                    data_manager.use_emission_factor(emission_factor)
+        unchanged = [file_path for file_path in file_paths if file_path in self.file_identities
+                     and self.file_identities[file_path] == self.get_file_identity(file_path)]
+        self.remove_files([file_path for file_path in self.file_paths if file_path not in unchanged])
+        self.cancelled = False
+        for done, file_path in enumerate(unchanged, 1):
+            if progress is not None:
+                progress(done, len(file_paths), file_path)
+
+        def load_progress(done, total, file_path):
+            progress(len(unchanged) + done, len(file_paths), file_path)
+
+        self.load_files([file_path for file_path in file_paths if file_path not in unchanged],
+                        load_progress if progress is not None else None, cancel)
+        order = sorted(range(len(self.file_paths)), key=lambda i: file_paths.index(self.file_paths[i]))
+        self.file_paths = [self.file_paths[i] for i in order]
+        for data_list in self.get_data_lists():
+            data_list[:] = [data_list[i] for i in order]
+        self.results = None
+
+    def remove_files(self, file_paths):
+        keep = [i for i, file_path in enumerate(self.file_paths) if file_path not in file_paths]
+        self.file_paths = [self.file_paths[i] for i in keep]
+        for data_list in self.get_data_lists():
+            data_list[:] = [data_list[i] for i in keep]
+        for file_path in file_paths:
+            for memo in (self.site_results, self.file_identities, self.missing_sheets, self.load_errors):
+                memo.pop(file_path, None)
+        self.results = None
+
+    def load_files(self, file_paths, progress=None, cancel=None):
+        # progress(done, total, file_path) is called after each workbook is added; setting the
+        # cancel event (a threading.Event) stops loading cleanly between workbooks
+        self.results = None
+        total = len(file_paths)
+        for done, workbook in enumerate(self.load_workbooks(file_paths), 1):
+            self.add_workbook(workbook)
+            if progress is not None:
+                progress(done, total, workbook.file_id)
+            if cancel is not None and cancel.is_set():
+                self.cancelled = True
+                break
+        if self.cache is not None:
+            self.cache.evict()
+
+    def load_workbooks(self, file_paths, categories=None):
+        # Every requested sheet of a workbook comes from a single read. With workers > 1 the workbooks
+        # are parsed in a process pool; map() keeps the results in file order.
+        if categories is None:
+            categories = self.categories
+        sheet_specs = [(cls.sheet_name, cls.numeric_columns, cls.key_columns) for category, cls in kpi_categories.items()
+                       if category in categories]
+        if self.workers > 1 and len(file_paths) > 1:
+            pool = ProcessPoolExecutor(max_workers=self.workers)
+            try:
+                yield from pool.map(load_workbook_columns, file_paths, repeat(sheet_specs), repeat(self.cache), repeat(self.chunk_size))
+            finally:
+                pool.shutdown(cancel_futures=True)  # drop queued workbooks when loading is cancelled
+        else:
+            for file_path in file_paths:
+                yield load_workbook_columns(file_path, sheet_specs, self.cache, self.chunk_size)
+
+    def add_workbook(self, workbook):
+        file_path = workbook.file_id
+        self.file_paths.append(file_path)
+        self.file_identities[file_path] = self.get_file_identity(file_path)
+        self.site_results.pop(file_path, None)
+        # Sheets of the categories not requested yet get a data object that reads them on first use
+        for category, data_list in zip(kpi_categories, self.get_data_lists()):
+            data_list.append(self.create_data(category, file_path))
+        self.use_workbook(workbook, self.categories)
+
+    def use_workbook(self, workbook, categories):
+        file_path = workbook.file_id
+        for stage, seconds in workbook.timings.items():
+            self.report.add(stage, site=file_path, seconds=seconds, rows=workbook.count_rows() if stage != 'cache_write' else 0)
+        if workbook.error:
+            self.load_errors[file_path] = workbook.error
+            self.report.log(logging.ERROR, f"Error occurred while reading the workbook: {workbook.error}", site=file_path, stage='sheet_read')
+        elif workbook.missing_sheets:
+            self.missing_sheets.setdefault(file_path, []).extend(workbook.missing_sheets)
+            self.report.log(logging.WARNING, f"Missing sheets: {', '.join(workbook.missing_sheets)}", site=file_path, stage='sheet_read')
+        i = self.file_paths.index(file_path)
+        for category, data_list in zip(kpi_categories, self.get_data_lists()):
+            if category in categories:
+                data_list[i] = self.create_data(category, file_path, loader=workbook)
+
+    def create_data(self, category, file_path, loader=None):
+        if category == 'area':
+            return Normalization_Factor(file_path, loader=loader)
+        return kpi_categories[category](file_path, self.emission_factor, loader=loader)
+
+    def add_categories(self, categories):
+        # Read the sheets of categories that were not requested so far for every loaded workbook
+        new_categories = [category for category in kpi_categories if category in categories and category not in self.categories]
+        if not new_categories:
+            return
+        for workbook in self.load_workbooks(self.file_paths, new_categories):
+            self.use_workbook(workbook, new_categories)
+        self.categories = [category for category in kpi_categories if category in self.categories or category in new_categories]
+        self.site_results.clear()  # memoized results only cover the previous categories
+        self.results = None
+        if self.cache is not None:
+            self.cache.evict()
+
+    def calculate(self):
+        # Portfolio results assembled from the memoized per-site results; the sites without one
+        # are calculated together in a single vectorized pass
+        if self.results is None:
+            pending = [file_path for file_path in dict.fromkeys(self.file_paths) if file_path not in self.site_results]
+            if pending:
+                self.site_results.update(zip(pending, self.calculate_sites(pending).split()))
+            if self.file_paths:
+                self.results = Emission_Results.combine([self.site_results[file_path] for file_path in self.file_paths])
+            else:
+                self.results = self.calculate_sites([])
+        return self.results
+
+    def validate(self):
+        # One issue table (see Data_Validator) for unreadable workbooks, missing sheets and the bad cells
+        # of every loaded sheet; sheets of categories that were not requested are not read for it
+        with self.report.stage('validation') as record:
+            validator = Data_Validator(self.emission_factor)
+            for file_path, error in self.load_errors.items():
+                validator.add_issue(file_path, None, None, 'error', f"Unreadable workbook: {error}")
+            for file_path, sheet_names in self.missing_sheets.items():
+                for sheet_name in sheet_names:
+                    validator.add_issue(file_path, sheet_name, None, 'error', "Missing sheet")
+            for category, data_list in zip(kpi_categories, self.get_data_lists()):
+                if category in self.categories:
+                    validator.validate([data_manager for data_manager in data_list if self.is_readable(data_manager)])
+            record['rows'] = sum(data_manager.columns.nrows for category, data_list in zip(kpi_categories, self.get_data_lists())
+                                 if category in self.categories for data_manager in data_list if data_manager.is_loaded())
+            record['errors'] = len(validator.issues)
+        return validator.get_report()
+
+    def get_cube(self, period='M'):
+        # Results_Cube of the current results (with floor area for intensities), rebuilt only when they change
+        self.add_categories(['area'])
+        results = self.calculate()
+        if self.cube is None or self.cube.results is not results or self.cube.period != period:
+            self.cube = Results_Cube(results, period)
+        return self.cube
+
+    def calculate_sites(self, file_paths):
+        indices = [self.file_paths.index(file_path) for file_path in file_paths]
+        calculator = Emission_Calculator(self.emission_factor, self.parameters, self.report)
+        return calculator.calculate(file_paths, *[self.get_readable([data_list[i] for i in indices]) for data_list in self.get_data_lists()],
+                                    categories=self.categories)
+
+    def is_readable(self, data_manager):
+        # False for the sheets of unreadable workbooks and for missing sheets; those are reported
+        # once, when the workbook is loaded, and not again for every category or column
+        return data_manager.file_id not in self.load_errors \
+            and data_manager.sheet_name not in self.missing_sheets.get(data_manager.file_id, [])
+
+    def get_readable(self, data_managers):
+        return [data_manager if self.is_readable(data_manager) else None for data_manager in data_managers]
+
+    def calculate_site(self, file_path):
+        # Results of a single loaded site, e.g. to report partial results while loading
+        if file_path not in self.site_results:
+            self.site_results[file_path] = self.calculate_sites([file_path])
+        return self.site_results[file_path]
+
+    def get_site_subtotals(self, file_path):
+        return self.calculate_site(file_path).get_totals()
 
     def calculate_total_area(self):
-        #print([nf.calculate_area() for nf in self.normalization_factors]) 
-        total_area = sum([nf.calculate_area() for nf in self.normalization_factors])
-        return total_area
+        self.add_categories(['area'])
+        return self.calculate().total('area', 'Area')
 
     def calculate_total_mobile_fuel_consumption(self):
-        total_mobile_fuel_consumption = sum([mf.calculate_mobile_fuel_consumption() for mf in self.mobile_fuel])
+        # Fuel consumption as read, including sites left out of the emissions for a missing factor
+        self.add_categories(['mobile_fuel'])
+        total_mobile_fuel_consumption = sum([mf.calculate_mobile_fuel_consumption() for mf in self.mobile_fuel if self.is_readable(mf)])
         return total_mobile_fuel_consumption
 
     def get_source_name(self, file_id):
+        if "Environmental_" not in file_id:
+            return os.path.splitext(os.path.basename(file_id))[0]
         start = file_id.find("Environmental_") + len("Environmental_")
         end = file_id.find(".xlsx")
         return file_id[start:end]
 
-    def calculate_emissions_from_mobile_fuel(self):        
-        Fuel_KWH_Total = 0
-        NOX_Total = 0
-        SOX_Total = 0
-        PM_Total = 0
-        CO2_Total = 0
-        CH4_Total = 0
-        N2O_Total = 0
-        for mf in self.mobile_fuel:
-            try:
-                source_name = self.get_source_name(mf.file_id)
-                #print(f"{mf.sheet_name} - from {source_name}:")
-                mobile_fuel_id_data = mf.get_mobile_fuel_id_data()
-                mobile_fuel_code_data = mf.get_mobile_fuel_code_data()
-                mobile_fuel_type_data = mf.get_mobile_fuel_type_data()
-                mobile_fuel_combined_code = []
-                for i in range(len(mobile_fuel_code_data)):
-                    combined_element = mobile_fuel_code_data[i] + mobile_fuel_type_data[i]
-                    mobile_fuel_combined_code.append(combined_element)
-                #mobile_fuel_combined_code = [(code, fuel_type) for code, fuel_type in zip(mobile_fuel_code_data, mobile_fuel_type_data)]
-                mobile_fuel_consumption_data = mf.get_mobile_fuel_data()
-                mobile_fuel_mileage_data = mf.get_mobile_mileage_data()
-                NOX_emission_factor = mf.get_mobile_fuel_emission_factors("NOx Emission", mobile_fuel_code_data)
-                SOX_emission_factor = mf.get_mobile_fuel_emission_factors("SOx Emission", mobile_fuel_type_data)
-                PM_emission_factor = mf.get_mobile_fuel_emission_factors("PM Emission", mobile_fuel_code_data)
-                CO2_emission_factor = mf.get_mobile_fuel_emission_factors("CO2 Emission", mobile_fuel_type_data)
-                CH4_emission_factor = mf.get_mobile_fuel_emission_factors("CH4 Emission", mobile_fuel_combined_code)
-                N2O_emission_factor = mf.get_mobile_fuel_emission_factors("N2O Emission", mobile_fuel_combined_code)
-                table = []
-                Fuel_KWH_Subtotal = 0
-                NOX_Subtotal = 0
-                SOX_Subtotal = 0
-                PM_Subtotal = 0
-                CO2_Subtotal = 0
-                CH4_Subtotal = 0
-                N2O_Subtotal = 0
-                for code, data, mileage, NOX_ef, SOX_ef, PM_ef, CO2_ef, CH4_ef, N2O_ef in zip(mobile_fuel_id_data, mobile_fuel_consumption_data, mobile_fuel_mileage_data, NOX_emission_factor, SOX_emission_factor, PM_emission_factor, CO2_emission_factor, CH4_emission_factor, N2O_emission_factor):                    
-                    table.append([code, data, mileage, data*NOX_ef, data*SOX_ef, data*PM_ef, data*CO2_ef, data*CH4_ef*28, data*N2O_ef*256])
-                    Fuel_KWH_Subtotal += data*9.11 #Net Calorific Value (kWh/L) = 9.11 for Unleaded Petrol
-                    NOX_Subtotal += mileage*NOX_ef
-                    SOX_Subtotal += data*SOX_ef
-                    PM_Subtotal += mileage*PM_ef
-                    CO2_Subtotal += data*CO2_ef
-                    CH4_Subtotal += data*CH4_ef*28
-                    N2O_Subtotal += data*N2O_ef*256
-                #print(tabulate(table, headers=['ID', 'Consumption Data', 'Mileage', 'Emission(NOx)', 'Emission(SOx)', 'Emission(PM)', 'Emission(CO2)', 'Emission(CH4)', 'Emission(N2O)'], stralign='left'))
-                print(f"Fuel usage in {source_name} is {Fuel_KWH_Subtotal} kWh")
-                Fuel_KWH_Total += Fuel_KWH_Subtotal
-                NOX_Total += NOX_Subtotal
-                SOX_Total += SOX_Subtotal
-                PM_Total += PM_Subtotal
-                CO2_Total += CO2_Subtotal
-                CH4_Total += CH4_Subtotal
-                N2O_Total += N2O_Subtotal
-                #print(f"NOx emission: {NOX_Subtotal:,.2f}")
-                #print(f"SOx emission: {SOX_Subtotal:,.2f}")
-                #print(f"PM emission: {PM_Subtotal:,.2f}")
-                #print(f"CO2 emission: {CO2_Subtotal:,.2f}")
-                #print(f"CH4 emission: {CH4_Subtotal:,.2f}")
-                #print(f"N2O emission: {N2O_Subtotal:,.2f}")
-            except Exception as e:
-                print(f"Error occurred while processing {mf.sheet_name}")
-                print(f"Error: {e}")
-                print(traceback.format_exc())
-        return NOX_Total, SOX_Total, PM_Total, CO2_Total, CH4_Total, N2O_Total
-
+    def calculate_emissions_from_mobile_fuel(self):
+        self.add_categories(['mobile_fuel'])
+        results = self.calculate()
+        for site, Fuel_KWH_Subtotal in zip(results.sites, results.site_totals['mobile_fuel']['Fuel kWh']):
+            logger.debug(f"Fuel usage in {self.get_source_name(site)} is {Fuel_KWH_Subtotal} kWh")
+        return tuple(results.total('mobile_fuel', metric) for metric in ['NOx', 'SOx', 'PM', 'CO2', 'CH4', 'N2O'])
 
     def calculate_emissions_from_energy_consumption(self):
-        CO2_Total = 0
-        Energy_Total = 0
-        for ec in self.energy_consumption:
-            try:
-                source_name = self.get_source_name(ec.file_id)
-                #print(f"{ec.sheet_name} - from {source_name}:")
-                energy_consumption_data = ec.get_energy_data()
-                energy_consumption_location = ec.get_location()
-                CO2_emission_factor = ec.get_energy_consumption_emission_factors("Purchased Electricity", energy_consumption_location)
-                table = []
-                CO2_Subtotal = 0
-                Energy_subtotal = 0
-                for data, location, CO2_ef in zip(energy_consumption_data, energy_consumption_location, CO2_emission_factor):                    
-                  if data is not None and CO2_ef is not None:
-                      table.append([data, location, data*CO2_ef])
-                      Energy_subtotal += data
-                      CO2_Subtotal += data*CO2_ef
-                  else:
-                      table.append([data, location, None])
-                #print(tabulate(table, headers=['Consumption Data', 'Location', 'Emission(CO2)'], stralign='left'))
-                print(f"Energy usage in {source_name} is {Energy_subtotal} kWh")
-                CO2_Total += CO2_Subtotal
-                Energy_Total += Energy_subtotal
-                #print(f"CO2 emission: {CO2_Subtotal:,.2f}")
-            except Exception as e:
-                print(f"Error occurred while processing {ec.sheet_name}")
-                print(f"Error: {e}")
-                print(traceback.format_exc())
-        return CO2_Total, Energy_Total
+        self.add_categories(['energy'])
+        results = self.calculate()
+        for site, Energy_subtotal in zip(results.sites, results.site_totals['energy']['Energy']):
+            logger.debug(f"Energy usage in {self.get_source_name(site)} is {Energy_subtotal} kWh")
+        return results.total('energy', 'CO2'), results.total('energy', 'Energy')
 
     def calculate_emissions_from_paper_consumption(self):
-        Paper_Total = 0
-        for pc in self.paper_consumption:
-            try:
-                source_name = self.get_source_name(pc.file_id)
-                paper_consumption_data = pc.get_paper_data()
-                table = []
-                Paper_Subtotal = 0
-                for data in paper_consumption_data:                    
-                    if data is not None:
-                        table.append([data])
-                        Paper_Subtotal += data/1000 #data is in gram
-                    else:
-                        table.append([None])
-                Paper_Total += Paper_Subtotal
-                print(source_name, Paper_Subtotal/1000)
-            except Exception as e:
-                print(f"Error occurred while processing {pc.sheet_name}")
-                print(f"Error: {e}")
-                print(traceback.format_exc())
-        return Paper_Total
+        self.add_categories(['paper'])
+        results = self.calculate()
+        for site, Paper_Subtotal in zip(results.sites, results.site_totals['paper']['Paper']):
+            logger.debug(f"Paper usage in {self.get_source_name(site)} is {Paper_Subtotal} kg")
+        return results.total('paper', 'Paper')
 
     def calculate_emissions_from_water_consumption(self):
-        Water_Total = 0
-        for wc in self.water_consumption:
-            try:
-                source_name = self.get_source_name(wc.file_id)
-                water_consumption_data = wc.get_paper_data()
-                table = []
-                Water_Subtotal = 0
-                for data in water_consumption_data:                    
-                    if data is not None:
-                        table.append([data])
-                        Water_Subtotal += data #data is in m3
-                    else:
-                        table.append([None])
-                Water_Total += Water_Subtotal
-                print(source_name, Water_Subtotal)
-            except Exception as e:
-                print(f"Error occurred while processing {wc.sheet_name}")
-                print(f"Error: {e}")
-                print(traceback.format_exc())
-        return Water_Total
-    
+        self.add_categories(['water'])
+        results = self.calculate()
+        for site, Water_Subtotal in zip(results.sites, results.site_totals['water']['Water']):
+            logger.debug(f"Water usage in {self.get_source_name(site)} is {Water_Subtotal} m3")
+        return results.total('water', 'Water')
+
+class Scenario_Results:
+    # Output of Emission_Scenarios: site_totals[category][metric] is a sites x scenarios array and
+    # errors holds the (scenario, site, sheet, message) of sites left out of a scenario's totals
+    def __init__(self, names, sites):
+        self.names = list(names)
+        self.sites = list(sites)
+        self.site_totals = {}
+        self.errors = []
+
+    def total(self, category, metric):
+        # One total per scenario
+        return self.site_totals[category][metric].sum(axis=0)
+
+    def get_comparison_table(self, baseline=None):
+        # One row per scenario and a '<category> <metric>' column per total; with a baseline
+        # scenario name the table holds the differences to that scenario instead
+        table = pd.DataFrame({f"{category} {metric}": values.sum(axis=0)
+                              for category, metrics in self.site_totals.items() for metric, values in metrics.items()},
+                             index=pd.Index(self.names, name='Scenario'))
+        if baseline is not None:
+            table = table - table.loc[baseline]
+        return table
+
+    def get_site_table(self, category, metric):
+        return pd.DataFrame(self.site_totals[category][metric], index=pd.Index(self.sites, name='File'), columns=self.names)
+
+class Emission_Scenarios:
+    # Evaluates the activity data of a loaded KPIs portfolio against several emission factor tables
+    # at once. The rows are reduced once to per-site activity totals for each distinct factor key
+    # (vehicle type and fuel type, location); a scenario then only resolves those keys, and every
+    # emission of all scenarios is one (sites x keys) @ (keys x scenarios) product. The exclusion
+    # rules of Emission_Calculator apply per scenario. Area, paper and water do not depend on the
+    # factors and are left out.
+    def __init__(self, kpi):
+        kpi.add_categories(['mobile_fuel', 'energy'])
+        self.kpi = kpi
+        self.sites = list(kpi.file_paths)
+        stacking = Emission_Results(self.sites)
+        calculator = Emission_Calculator(kpi.emission_factor, kpi.parameters, kpi.report)
+        site_index, columns = calculator.stack(kpi.get_readable(kpi.mobile_fuel), stacking, lambda mf: (
+            mf.get_mobile_fuel_code_data(), mf.get_mobile_fuel_type_data(), mf.get_mobile_fuel_data(), mf.get_mobile_mileage_data()),
+            calculator.get_empty_columns(['text', 'text', 'number', 'number']))
+        codes, fuel_types, fuel, mileage = columns
+        inverse, first_rows = self.factorize_keys(concat_categories(codes, fuel_types))
+        self.mobile_keys = (codes[first_rows], fuel_types[first_rows])
+        self.mobile_activity = {
+            'count': self.get_activity(site_index, inverse, len(first_rows), None),
+            'fuel': self.get_activity(site_index, inverse, len(first_rows), fuel),
+            'mileage': self.get_activity(site_index, inverse, len(first_rows), mileage),
+        }
+        site_index, columns = calculator.stack(kpi.get_readable(kpi.energy_consumption), stacking, lambda ec: (ec.get_location(), ec.get_energy_data()),
+                                                 calculator.get_empty_columns(['text', 'number']))
+        locations, energy = columns
+        inverse, first_rows = self.factorize_keys(locations)
+        self.energy_keys = locations[first_rows]
+        self.energy_activity = self.get_activity(site_index, inverse, len(first_rows), energy)
+        self.energy_counts = self.get_activity(site_index, inverse, len(first_rows), None)
+        self.errors = stacking.errors  # (site, sheet, message) of sites whose activity could not be read
+
+    def factorize_keys(self, column):
+        # Key number of every row plus the first row of each key; rows with a missing value share one key
+        inverse, uniques = pd.factorize(column, use_na_sentinel=False)
+        first_rows = np.unique(inverse, return_index=True)[1]
+        return inverse, first_rows
+
+    def get_activity(self, site_index, inverse, nkeys, values):
+        # sites x keys sums of values (or row counts)
+        cells = site_index * nkeys + inverse
+        return np.bincount(cells, weights=values, minlength=len(self.sites) * nkeys).reshape(len(self.sites), nkeys)
+
+    @staticmethod
+    def get_scenario_names(paths, taken=()):
+        # File names without extension; a name already used (or in taken) gets ' (2)', ' (3)', ...
+        names = []
+        for path in paths:
+            name = os.path.splitext(os.path.basename(path))[0]
+            candidate, count = name, 1
+            while candidate in names or candidate in taken:
+                count += 1
+                candidate = f"{name} ({count})"
+            names.append(candidate)
+        return names
+
+    def evaluate(self, factor_tables):
+        # factor_tables: {scenario name: Emission_Factor or factor workbook path}, or a list of paths
+        # named by get_scenario_names()
+        if not isinstance(factor_tables, dict):
+            factor_tables = list(factor_tables)
+            factor_tables = dict(zip(self.get_scenario_names(factor_tables), factor_tables))
+        names = list(factor_tables)
+        tables = [table if isinstance(table, Emission_Factor) else Emission_Factor_Registry.get(table) for table in factor_tables.values()]
+        results = Scenario_Results(names, self.sites)
+        for name in names:
+            results.errors.extend((name, site, sheet, message) for site, sheet, message in self.errors)
+        self.evaluate_mobile_fuel(names, tables, results)
+        self.evaluate_energy_consumption(names, tables, results)
+        return results
+
+    def evaluate_mobile_fuel(self, names, tables, results):
+        codes, fuel_types = self.mobile_keys
+        combined = concat_categories(codes, fuel_types)
+        ncv, gwp_ch4, gwp_n2o, factors = [], [], [], []
+        for table in tables:
+            matrix, _ = table.get_emission_factor_matrix(mobile_fuel_emission_types, "|Mobile Combustion Sources|",
+                                                         [codes, fuel_types, codes, fuel_types, combined, combined])
+            calculator = Emission_Calculator(table, self.kpi.parameters)  # the scenario's parameters and overrides
+            ncv.append(calculator.get_parameter_column('Net Calorific Value', fuel_types))
+            gwp_ch4.append(calculator.parameters['CH4 GWP'])
+            gwp_n2o.append(calculator.parameters['N2O GWP'])
+            factors.append(matrix)
+        factors = np.stack(factors, axis=2) if factors else np.zeros((len(combined), len(mobile_fuel_emission_types), 0))  # keys x emissions x scenarios
+        missing = np.isnan(factors).any(axis=1)
+        factors = np.nan_to_num(factors)
+        # A site with any vehicle entry without a factor is left out of that scenario's mobile totals
+        missing_counts = self.mobile_activity['count'] @ missing
+        valid = missing_counts == 0
+        for k, name in enumerate(names):
+            for i in np.flatnonzero(~valid[:, k]):
+                results.errors.append((name, self.sites[i], Mobile_Fuel.sheet_name,
+                                       f"No emission factor for {int(missing_counts[i, k])} vehicle entries"))
+        fuel, mileage = self.mobile_activity['fuel'], self.mobile_activity['mileage']
+        NOX_ef, SOX_ef, PM_ef, CO2_ef, CH4_ef, N2O_ef = factors.transpose(1, 0, 2)
+        values = {
+            'Fuel kWh': fuel @ np.array(ncv).reshape(len(tables), len(combined)).T,
+            'NOx': mileage @ NOX_ef,
+            'SOx': fuel @ SOX_ef,
+            'PM': mileage @ PM_ef,
+            'CO2': fuel @ CO2_ef,
+            'CH4': fuel @ (CH4_ef * np.array(gwp_ch4)),
+            'N2O': fuel @ (N2O_ef * np.array(gwp_n2o)),
+        }
+        results.site_totals['mobile_fuel'] = {metric: np.where(valid, site_values, 0.0) for metric, site_values in values.items()}
+
+    def evaluate_energy_consumption(self, names, tables, results):
+        factors = [table.get_emission_factor_matrix(["Purchased Electricity"], "|", [self.energy_keys])[0][:, 0] for table in tables]
+        factors = np.stack(factors, axis=1) if factors else np.zeros((len(self.energy_keys), 0))  # keys x scenarios
+        # Rows without a factor are left out of both the CO2 and the energy totals
+        valid = ~np.isnan(factors)
+        missing_counts = self.energy_counts @ ~valid
+        for k, name in enumerate(names):
+            for i in np.flatnonzero(missing_counts[:, k]):
+                results.errors.append((name, self.sites[i], Energy_Consumption.sheet_name,
+                                       f"No emission factor for {int(missing_counts[i, k])} energy rows"))
+        results.site_totals['energy'] = {
+            'CO2': self.energy_activity @ np.nan_to_num(factors),
+            'Energy': self.energy_activity @ valid,
+        }
@@ -0,0 +1,134 @@
+# Run instrumentation for the KPI pipeline: per-stage and per-site wall time, row and error counts
+# (Run_Report), plus optional cProfile / tracemalloc capture (Profiler), enabled with the
+# ESG_KPI_PROFILE environment variable ("cprofile", "tracemalloc" or both, comma separated)
+# or the --profile option of KPI_Batch.py.
+from contextlib import contextmanager
+import io
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger('esg_kpis')
+
+class Run_Report:
+    def __init__(self):
+        self.records = []  # one dict per (stage, site) measurement
+        self.messages = []
+        self.profile = {}
+        self.started = time.time()
+
+    def add(self, stage, site=None, seconds=0.0, rows=0, errors=0):
+        self.records.append({'stage': stage, 'site': site, 'seconds': seconds, 'rows': rows, 'errors': errors})
+
+    @contextmanager
+    def stage(self, stage, site=None, rows=0):
+        # Times the block; the yielded record can be updated (e.g. record['rows'] = n) inside it
+        record = {'stage': stage, 'site': site, 'seconds': 0.0, 'rows': rows, 'errors': 0}
+        start = time.perf_counter()
+        try:
+            yield record
+        except Exception:
+            record['errors'] += 1
+            raise
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            self.records.append(record)
+
+    def log(self, level, message, site=None, stage=None):
+        # Warnings and errors also count as errors of their stage and site
+        self.messages.append({'level': logging.getLevelName(level), 'site': site, 'stage': stage, 'message': message})
+        if level >= logging.WARNING and stage is not None:
+            self.add(stage, site=site, errors=1)
+        logger.log(level, f"{site}: {message}" if site else message)
+
+    def get_stage_summary(self):
+        summary = {}
+        for record in self.records:
+            stage = summary.setdefault(record['stage'], {'seconds': 0.0, 'rows': 0, 'errors': 0, 'sites': set()})
+            stage['seconds'] += record['seconds']
+            stage['rows'] += record['rows']
+            stage['errors'] += record['errors']
+            if record['site'] is not None:
+                stage['sites'].add(record['site'])
+        for stage in summary.values():
+            stage['sites'] = len(stage['sites'])
+        return summary
+
+    def get_site_summary(self):
+        summary = {}
+        for record in self.records:
+            if record['site'] is None:
+                continue
+            site = summary.setdefault(record['site'], {'seconds': 0.0, 'rows': 0, 'errors': 0})
+            site['seconds'] += record['seconds']
+            site['rows'] += record['rows']
+            site['errors'] += record['errors']
+        return summary
+
+    def to_dict(self):
+        return {
+            'started': self.started,
+            'stages': self.get_stage_summary(),
+            'sites': self.get_site_summary(),
+            'records': self.records,
+            'messages': self.messages,
+            'profile': self.profile,
+        }
+
+    def to_json(self, file_path):
+        with open(file_path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, indent=2, ensure_ascii=False)
+
+    def format_text(self, slowest=5):
+        lines = ["Run report:"]
+        for name, stage in self.get_stage_summary().items():
+            lines.append(f"{name}: {stage['seconds']:.3f} s, {stage['rows']:,} rows, {stage['sites']} sites, {stage['errors']} errors")
+        sites = sorted(self.get_site_summary().items(), key=lambda item: item[1]['seconds'], reverse=True)
+        if sites:
+            lines.append("Slowest sites:")
+            for site, totals in sites[:slowest]:
+                lines.append(f"{os.path.basename(site)}: {totals['seconds']:.3f} s, {totals['rows']:,} rows, {totals['errors']} errors")
+        for message in self.messages:
+            if message['level'] in ('WARNING', 'ERROR'):
+                site = f"{os.path.basename(message['site'])}: " if message['site'] else ""
+                lines.append(f"{message['level']} {site}{message['message']}")
+        if 'tracemalloc' in self.profile:
+            lines.append(f"Peak traced memory: {self.profile['tracemalloc']['peak_mb']:.1f} MB")
+        return "\n".join(lines)
+
+class Profiler:
+    def __init__(self, modes=None, top=25):
+        if modes is None:
+            modes = os.environ.get('ESG_KPI_PROFILE', '')
+        self.modes = {mode.strip().lower() for mode in modes.split(',') if mode.strip()}
+        self.top = top
+        self.results = {}
+
+    def __enter__(self):
+        if 'tracemalloc' in self.modes:
+            import tracemalloc
+            tracemalloc.start()
+        if 'cprofile' in self.modes:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        if 'cprofile' in self.modes:
+            import pstats
+            self.profiler.disable()
+            stream = io.StringIO()
+            pstats.Stats(self.profiler, stream=stream).sort_stats('cumulative').print_stats(self.top)
+            self.results['cprofile'] = stream.getvalue()
+        if 'tracemalloc' in self.modes:
+            import tracemalloc
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self.results['tracemalloc'] = {
+                'peak_mb': peak / (1024 * 1024),
+                'top': [str(stat) for stat in snapshot.statistics('lineno')[:self.top]],
+            }
+        return False
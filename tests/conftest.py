@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from KPI_Benchmark import generate_portfolio
+
+@pytest.fixture(scope='session')
+def portfolio(tmp_path_factory):
+    # Three generated sites, their emission factor workbook and a file that is not a workbook
+    directory = tmp_path_factory.mktemp('portfolio')
+    file_paths, emission_factor_file_path = generate_portfolio(str(directory), 3, 60, seed=1)
+    broken = directory / 'Environmental_Broken.xlsx'
+    broken.write_bytes(b'not a workbook')
+    return file_paths, emission_factor_file_path, str(broken)
@@ -0,0 +1,342 @@
+import datetime
+import json
+import logging
+import os
+import random
+import shutil
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+from openpyxl import Workbook, load_workbook
+
+import KPI_Batch
+from KPI_Benchmark import generate_emission_factors
+from KPI_Controller import KPIs, Emission_Scenarios, Results_Table, Sheet_Cache, load_workbook_columns
+
+def assert_same_results(results, expected):
+    assert results.sites == expected.sites
+    assert sorted(results.errors) == sorted(expected.errors)
+    assert results.get_totals() == expected.get_totals()
+    for category, rows in expected.rows.items():
+        assert list(results.rows[category]) == list(rows)
+        for name, values in rows.items():
+            np.testing.assert_array_equal(np.asarray(results.rows[category][name]), np.asarray(values))
+
+def assert_close_results(results, expected, rel):
+    # Same sites and errors, and totals per site equal up to the summation order
+    assert results.sites == expected.sites
+    assert sorted(results.errors) == sorted(expected.errors)
+    for category, metrics in expected.site_totals.items():
+        assert list(results.site_totals[category]) == list(metrics)
+        for metric, values in metrics.items():
+            np.testing.assert_allclose(results.site_totals[category][metric], values, rtol=rel)
+
+def test_memoized_sites_combine_with_unreadable_workbook(portfolio):
+    # Sites calculated one at a time (as the GUI does while loading) must combine into the same
+    # results as one pass, also when the first site has no readable rows
+    file_paths, emission_factor_file_path, broken = portfolio
+    kpi = KPIs([], emission_factor_file_path)
+    kpi.update_files([broken] + file_paths, progress=lambda done, total, file_path: kpi.calculate_site(file_path))
+    results = kpi.calculate()
+    assert {'ID', 'Type', 'Fuel Type', 'Consumption', 'Mileage', 'Date'} <= set(results.rows['mobile_fuel'])
+    assert_same_results(results, KPIs([broken] + file_paths, emission_factor_file_path).calculate())
+
+def test_scenarios_with_the_same_file_name_stay_separate(portfolio, tmp_path):
+    file_paths, emission_factor_file_path, _ = portfolio
+    copy_path = tmp_path / os.path.basename(emission_factor_file_path)
+    shutil.copy(emission_factor_file_path, copy_path)
+    scenarios = Emission_Scenarios(KPIs(file_paths, emission_factor_file_path)).evaluate([emission_factor_file_path, str(copy_path)])
+    assert scenarios.names == ['Emission_Factors', 'Emission_Factors (2)']
+    table = scenarios.get_comparison_table()
+    assert len(table) == 2
+    assert (table.loc['Emission_Factors'] == table.loc['Emission_Factors (2)']).all()
+
+def test_streamed_validation_matches_in_memory(portfolio):
+    # Streamed sheets only keep their key columns, which must not be reported as blank IDs
+    file_paths, emission_factor_file_path, broken = portfolio
+    expected = KPIs([broken] + file_paths, emission_factor_file_path).validate()
+    issues = KPIs([broken] + file_paths, emission_factor_file_path, chunk_size=7).validate()
+    # The unreadable workbook's message names the reader's exception, which differs between the two loaders
+    columns = ['File', 'Sheet', 'Column', 'Count']
+    assert issues[columns].values.tolist() == expected[columns].values.tolist()
+    assert 'Missing value' not in set(issues['Issue'])
+
+def test_streamed_intraday_dates_are_keyed_by_day(portfolio, tmp_path):
+    # 15-minute meter readings over a few days: the streamed store keeps one row per day and
+    # location and gives the same monthly results as the row-level store
+    _, emission_factor_file_path, _ = portfolio
+    file_path = str(tmp_path / 'Environmental_Meter.xlsx')
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Energy_Consumption')
+    sheet.append(['Location', 'Energy Consumption', 'Date'])
+    sheet.append(['', 'kWh', ''])
+    start = datetime.datetime(2023, 1, 30)
+    for i in range(500):
+        sheet.append([['Hong Kong', 'Shenzhen'][i % 2], 1.0 + i % 7, start + datetime.timedelta(minutes=15 * i)])
+    workbook.save(file_path)
+    kpi = KPIs([file_path], emission_factor_file_path, chunk_size=64, categories=['energy'])
+    expected = KPIs([file_path], emission_factor_file_path, categories=['energy'])
+    assert kpi.energy_consumption[0].columns.nrows == 12
+    frame, expected_frame = kpi.get_cube().to_frame(), expected.get_cube().to_frame()
+    assert list(frame['Period']) == list(expected_frame['Period'])
+    np.testing.assert_allclose(frame['Value'], expected_frame['Value'], rtol=1e-9)
+
+def test_cube_rejects_unknown_or_ambiguous_measures(portfolio):
+    file_paths, emission_factor_file_path, _ = portfolio
+    cube = KPIs(file_paths, emission_factor_file_path).get_cube()
+    assert cube.total('energy', 'CO2') > 0
+    for category, metric in [('energy', 'C02'), ('enrgy', 'CO2'), ('enrgy', None)]:
+        with pytest.raises(KeyError, match='Unknown measure'):
+            cube.total(category, metric)
+        with pytest.raises(KeyError, match='Unknown measure'):
+            cube.rollup(category, metric)
+    with pytest.raises(ValueError):
+        cube.rollup('energy', None)
+    assert cube.rollup('water', None).equals(cube.rollup('water', 'Water'))
+
+def test_unreadable_workbook_is_reported_once(portfolio):
+    file_paths, emission_factor_file_path, broken = portfolio
+    kpi = KPIs([broken] + file_paths, emission_factor_file_path)
+    assert list(kpi.load_errors) == [broken]
+    assert kpi.calculate().errors == []
+    assert Emission_Scenarios(kpi).errors == []
+    issues = kpi.validate()
+    assert list(issues['File']) == [broken]
+
+def test_cache_stores_time_and_datetime_cells(tmp_path):
+    file_path = str(tmp_path / 'Environmental_Kinds.xlsx')
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Water_Consumption')
+    sheet.append(['Water Consumption', 'Date'])
+    sheet.append(['m3', ''])
+    sheet.append([1.0, datetime.time(10, 15)])
+    sheet.append([2.0, datetime.datetime(2024, 1, 1, 10)])
+    sheet.append([3.0, 'n/a'])
+    sheet.append([4.0, True])
+    workbook.save(file_path)
+    cache = Sheet_Cache(str(tmp_path / 'cache'))
+    specs = [('Water_Consumption', ['Water Consumption'], []), ('Paper_Usage', ['Usage (kg)'], [])]
+    parsed = load_workbook_columns(file_path, specs, cache)
+    cached = load_workbook_columns(file_path, specs, cache)
+    assert 'sheet_read' in parsed.timings and 'sheet_read' not in cached.timings
+    assert cached.missing_sheets == ['Paper_Usage']
+    expected, columns = parsed.columns['Water_Consumption'].text['Date'], cached.columns['Water_Consumption'].text['Date']
+    assert list(columns.categories) == list(expected.categories)
+    assert [type(category) for category in columns.categories] == [type(category) for category in expected.categories]
+    np.testing.assert_array_equal(columns.codes, expected.codes)
+
+def test_uncacheable_sheet_is_reported_and_parsed_alone(portfolio, tmp_path, caplog):
+    file_paths, _, _ = portfolio
+    cache = Sheet_Cache(str(tmp_path))
+    specs = [('Water_Consumption', ['Water Consumption'], []), ('Energy_Consumption', ['Energy Consumption'], [])]
+    # The energy sheet stands in for a sheet with cells of a type the cache cannot store
+    energy_key = cache.get_key(cache.get_file_hash(file_paths[0]), 'Energy_Consumption', ['Energy Consumption'])
+    cache.save = lambda key, columns, save=cache.save: key != energy_key and save(key, columns)
+    with caplog.at_level(logging.WARNING, logger='esg_kpis'):
+        load_workbook_columns(file_paths[0], specs, cache)
+    assert 'Energy_Consumption is not cached' in caplog.text
+    assert len(os.listdir(tmp_path)) == 1
+    workbook = load_workbook_columns(file_paths[0], specs, cache)
+    assert sorted(workbook.columns) == ['Energy_Consumption', 'Water_Consumption']
+    assert 'sheet_read' in workbook.timings
+
+def test_corrupt_cache_entry_is_parsed_again(portfolio, tmp_path):
+    file_paths, emission_factor_file_path, _ = portfolio
+    cache = Sheet_Cache(str(tmp_path))
+    expected = KPIs(file_paths, emission_factor_file_path, cache=cache).calculate()
+    entry = cache.get_path(cache.get_key(cache.get_file_hash(file_paths[0]), 'Energy_Consumption', ['Energy Consumption']))
+    with open(entry, 'r+b') as f:
+        f.truncate(os.path.getsize(entry) // 2)
+    kpi = KPIs(file_paths, emission_factor_file_path, cache=cache)
+    assert kpi.load_errors == {}
+    assert_same_results(kpi.calculate(), expected)
+    assert cache.load(os.path.basename(entry)[:-len('.npz')]) is not None  # written again
+
+def write_energy_site(file_path, rows):
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Energy_Consumption')
+    sheet.append(['Location', 'Energy Consumption'])
+    sheet.append(['', 'kWh'])
+    for row in rows:
+        sheet.append(row)
+    workbook.save(file_path)
+
+def test_energy_rows_without_factor_are_reported(portfolio, tmp_path):
+    _, emission_factor_file_path, _ = portfolio
+    file_path = str(tmp_path / 'Environmental_Mars.xlsx')
+    write_energy_site(file_path, [['Hong Kong', 100.0], ['Mars', 50.0], ['Mars', 5.0], ['Shenzhen', 20.0]])
+    kpi = KPIs([file_path], emission_factor_file_path, categories=['energy'])
+    results = kpi.calculate()
+    assert results.errors == [(file_path, 'Energy_Consumption', "No emission factor for 2 energy rows")]
+    assert results.total('energy', 'Energy') == 120.0
+    scenarios = Emission_Scenarios(kpi).evaluate({'a': emission_factor_file_path})
+    assert scenarios.errors == [('a', file_path, 'Energy_Consumption', "No emission factor for 2 energy rows")]
+    assert KPI_Batch.main([emission_factor_file_path, file_path, '--categories', 'energy', '--no-cache', '--json', str(tmp_path / 'out.json')]) == 1
+    write_energy_site(file_path, [['Hong Kong', 100.0]])
+    assert KPI_Batch.main([emission_factor_file_path, file_path, '--categories', 'energy', '--no-cache', '--json', str(tmp_path / 'out.json')]) == 0
+
+def test_intensity_without_floor_area_is_null(portfolio, tmp_path):
+    _, emission_factor_file_path, _ = portfolio
+    file_path = str(tmp_path / 'Environmental_NoArea.xlsx')
+    write_energy_site(file_path, [['Hong Kong', 100.0]])
+    cube = KPIs([file_path], emission_factor_file_path, categories=['energy']).get_cube()
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        assert np.isnan(cube.intensity('energy', 'CO2', by=None))
+        assert cube.intensity('energy', 'CO2').isna().all()
+        assert cube.intensity('energy', 'CO2', by='period').isna().all()
+        assert cube.intensity('energy', 'CO2', by='group', groups={file_path: 'HK'}).isna().all()
+    output = tmp_path / 'out.json'
+    KPI_Batch.main([emission_factor_file_path, file_path, '--categories', 'energy', '--period', 'M', '--no-cache', '--json', str(output)])
+    assert json.loads(output.read_text())['intensity'] == {'energy CO2': None, 'energy Energy': None}
+
+def test_total_mobile_fuel_consumption_loads_the_category(portfolio):
+    file_paths, emission_factor_file_path, broken = portfolio
+    kpi = KPIs(file_paths + [broken], emission_factor_file_path, categories=['water'])
+    total = kpi.calculate_total_mobile_fuel_consumption()
+    assert 'mobile_fuel' in kpi.categories
+    assert total == pytest.approx(float(KPIs(file_paths, emission_factor_file_path).calculate().rows['mobile_fuel']['Consumption'].sum()))
+
+def test_columns_stay_row_aligned_with_blank_and_non_numeric_cells(portfolio, tmp_path):
+    # Blank and unreadable cells in different rows of different columns, and a blank row
+    _, emission_factor_file_path, _ = portfolio
+    file_path = str(tmp_path / 'Environmental_Gaps.xlsx')
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Mobile_Fuel')
+    sheet.append(['Transportation License #', 'Types of Transportation', 'Fuel Types', 'Fuel Consumption', 'Distance Travelled during the period/km'])
+    sheet.append(['', '', '', 'L', 'km'])
+    sheet.append(['V1', 'Private Car', 'Diesel Oil', 10.0, 100.0])  # Excel row 3
+    sheet.append(['V2', 'Private Car', 'Diesel Oil', None, 200.0])
+    sheet.append([None, None, None, None, None])
+    sheet.append(['V3', 'Motorcycle', 'LPG', 'unknown', None])
+    sheet.append([None, 'Private Car', 'Diesel Oil', 30.0, 300.0])
+    sheet.append(['V5', 'Motorcycle', 'LPG', 40.0, 'far'])
+    workbook.save(file_path)
+    kpi = KPIs([file_path], emission_factor_file_path, categories=['mobile_fuel'])
+    columns = kpi.mobile_fuel[0].columns
+    assert columns.nrows == 5
+    np.testing.assert_array_equal(columns.row_numbers, [3, 4, 6, 7, 8])
+    consumption, mileage = 'Fuel Consumption', 'Distance Travelled during the period/km'
+    np.testing.assert_array_equal(columns.numeric[consumption], [10, 0, 0, 30, 40])
+    np.testing.assert_array_equal(columns.null_masks[consumption], [False, True, False, False, False])
+    np.testing.assert_array_equal(columns.invalid_masks[consumption], [False, False, True, False, False])
+    np.testing.assert_array_equal(columns.numeric[mileage], [100, 200, 0, 300, 0])
+    np.testing.assert_array_equal(columns.null_masks[mileage], [False, False, True, False, False])
+    np.testing.assert_array_equal(columns.invalid_masks[mileage], [False, False, False, False, True])
+    np.testing.assert_array_equal(columns.null_masks['Transportation License #'], [False, False, False, True, False])
+    assert list(columns.text['Fuel Types']) == ['Diesel Oil', 'Diesel Oil', 'LPG', 'Diesel Oil', 'LPG']
+    factors = {code: factor for code, factor in load_workbook(emission_factor_file_path, read_only=True)['Emission_factors'].iter_rows(
+        min_row=2, values_only=True)}
+    source = ' Emission|Mobile Combustion Sources|'
+    totals = kpi.calculate().get_totals()['mobile_fuel']
+    assert totals['CO2'] == pytest.approx(40 * factors['CO2' + source + 'Diesel Oil'] + 40 * factors['CO2' + source + 'LPG'], rel=1e-12)
+    assert totals['NOx'] == pytest.approx(600 * factors['NOx' + source + 'Private Car'], rel=1e-12)
+    assert totals['Fuel kWh'] == pytest.approx(80 * 9.11, rel=1e-12)
+
+def get_sample_table():
+    return Results_Table({
+        'Site': pd.Categorical(['b', 'a', None, 'c', 'a']),
+        'Date': np.array(['2024-01-05', 'NaT', '2024-03-01', '2023-12-31', '2024-01-20'], dtype='datetime64[ns]'),
+        'Consumption': np.array([0.0, 80.0, np.nan, 20.0, 61.0]),
+        'Mileage': np.array([100.0, 0.0, 5.0, 70.0, 10.0]),
+    })
+
+def test_results_table_sorts_blanks_last():
+    table = get_sample_table()
+    table.sort('Consumption')
+    np.testing.assert_array_equal(table.view, [0, 3, 4, 1, 2])
+    table.sort('Consumption', descending=True)
+    np.testing.assert_array_equal(table.view, [1, 4, 3, 0, 2])
+    table.sort('Site', descending=True)
+    np.testing.assert_array_equal(table.view, [3, 0, 1, 4, 2])
+    table.sort('Date')
+    np.testing.assert_array_equal(table.view, [3, 0, 4, 2, 1])
+    assert table.get_rows(0, 2) == [('c', '2023-12-31', '20.00', '70.00'), ('b', '2024-01-05', '0.00', '100.00')]
+    assert table.get_rows(4, 10) == [('a', '', '80.00', '0.00')]
+
+def test_results_table_filters():
+    table = get_sample_table()
+    table.filter('A')
+    np.testing.assert_array_equal(table.view, [1, 4])
+    table.filter('2024-01')
+    np.testing.assert_array_equal(table.view, [0, 4])
+    table.filter('>60', 'Consumption')
+    np.testing.assert_array_equal(table.view, [1, 4])
+    table.sort('Consumption')
+    np.testing.assert_array_equal(table.view, [4, 1])
+    table.filter('<=0', 'Mileage')
+    np.testing.assert_array_equal(table.view, [1])
+    # Comparing every column would keep the row with Consumption 0 for its Mileage
+    with pytest.raises(ValueError):
+        table.filter('>60')
+    np.testing.assert_array_equal(table.view, [1])
+    table.filter('')
+    assert len(table) == 5
+
+def test_results_table_exports_the_view(portfolio, tmp_path):
+    file_paths, emission_factor_file_path, _ = portfolio
+    table = KPIs(file_paths, emission_factor_file_path).calculate().get_table('mobile_fuel')
+    table.filter('>1000', 'Consumption')
+    table.sort('NOx', descending=True)
+    table.to_csv(str(tmp_path / 'rows.csv'), chunk_size=7)
+    frame = pd.read_csv(tmp_path / 'rows.csv')
+    expected = table.get_frame(0, len(table))
+    assert list(frame.columns) == table.names
+    assert len(frame) == len(table) > 0
+    assert list(frame['ID']) == list(expected['ID'])
+    np.testing.assert_allclose(frame['NOx'], expected['NOx'], rtol=1e-12)
+    assert (frame['Consumption'] > 1000).all() and frame['NOx'].is_monotonic_decreasing
+    table.to_xlsx(str(tmp_path / 'rows.xlsx'), chunk_size=7)
+    rows = list(load_workbook(tmp_path / 'rows.xlsx', read_only=True).active.iter_rows(values_only=True))
+    assert list(rows[0]) == table.names and len(rows) == len(table) + 1
+    assert [row[table.names.index('ID')] for row in rows[1:]] == list(expected['ID'])
+
+def test_streamed_workbooks_give_the_same_results(portfolio):
+    # Streamed sheets are summed per key first, so only the summation order differs
+    file_paths, emission_factor_file_path, broken = portfolio
+    kpi = KPIs([broken] + file_paths, emission_factor_file_path, chunk_size=7)
+    assert list(kpi.load_errors) == [broken]
+    assert kpi.mobile_fuel[1].columns.row_numbers is None
+    assert_close_results(kpi.calculate(), KPIs([broken] + file_paths, emission_factor_file_path).calculate(), 1e-12)
+
+def test_worker_pool_gives_the_same_results(portfolio):
+    file_paths, emission_factor_file_path, broken = portfolio
+    kpi = KPIs([broken] + file_paths, emission_factor_file_path, workers=2)
+    assert list(kpi.load_errors) == [broken]
+    assert_same_results(kpi.calculate(), KPIs([broken] + file_paths, emission_factor_file_path).calculate())
+
+def test_cached_sheets_give_the_same_results(portfolio, tmp_path):
+    file_paths, emission_factor_file_path, broken = portfolio
+    cache = Sheet_Cache(str(tmp_path))
+    expected = KPIs([broken] + file_paths, emission_factor_file_path, cache=cache).calculate()
+    kpi = KPIs([broken] + file_paths, emission_factor_file_path, cache=cache)
+    assert list(kpi.load_errors) == [broken]
+    stages = {(record['stage'], record['site']) for record in kpi.report.records}
+    assert all(('cache_read', file_path) in stages and ('sheet_read', file_path) not in stages for file_path in file_paths)
+    assert_same_results(kpi.calculate(), expected)
+
+def test_incremental_updates_match_a_full_run(portfolio):
+    # Sites added, reordered and removed after some were calculated one at a time
+    file_paths, emission_factor_file_path, broken = portfolio
+    kpi = KPIs(file_paths[:2], emission_factor_file_path)
+    for file_path in file_paths[:2]:
+        kpi.calculate_site(file_path)
+    kpi.update_files([file_paths[2], broken] + file_paths[:2])
+    assert_same_results(kpi.calculate(), KPIs([file_paths[2], broken] + file_paths[:2], emission_factor_file_path).calculate())
+    kpi.update_files(file_paths[1:])
+    assert_same_results(kpi.calculate(), KPIs(file_paths[1:], emission_factor_file_path).calculate())
+
+def test_scenarios_match_separate_runs(portfolio, tmp_path):
+    file_paths, emission_factor_file_path, _ = portfolio
+    other_file_path = str(tmp_path / 'Emission_Factors_2024.xlsx')
+    generate_emission_factors(other_file_path, random.Random(2))
+    scenarios = Emission_Scenarios(KPIs(file_paths, emission_factor_file_path)).evaluate(
+        {'2023': emission_factor_file_path, '2024': other_file_path})
+    for name, factor_file_path in [('2023', emission_factor_file_path), ('2024', other_file_path)]:
+        totals = KPIs(file_paths, factor_file_path).calculate().get_totals()
+        for category, metrics in scenarios.site_totals.items():
+            for metric in metrics:
+                total = scenarios.total(category, metric)[scenarios.names.index(name)]
+                assert total == pytest.approx(totals[category][metric], rel=1e-12), (name, category, metric)
@@ -0,0 +1,62 @@
+import pytest
+from openpyxl import load_workbook
+
+from KPI_Controller import KPIs
+
+def read_rows(file_path, sheet_name):
+    # Data rows of a sheet as dicts, without the units row under the header
+    rows = load_workbook(file_path, read_only=True)[sheet_name].iter_rows(values_only=True)
+    header = next(rows)
+    next(rows)
+    return [dict(zip(header, row)) for row in rows]
+
+def read_factor_rows(file_path):
+    # (code, factor) rows of the emission factor sheet, which has no units row
+    rows = load_workbook(file_path, read_only=True)['Emission_factors'].iter_rows(values_only=True)
+    next(rows)
+    return list(rows)
+
+def get_reference_totals(file_paths, emission_factor_file_path):
+    # The per-row loops the vectorized calculator replaced, with the default parameters
+    factors = dict(read_factor_rows(emission_factor_file_path))
+    source = '|Mobile Combustion Sources|'
+    totals = {'area': {'Area': 0}, 'mobile_fuel': dict.fromkeys(['Fuel kWh', 'NOx', 'SOx', 'PM', 'CO2', 'CH4', 'N2O'], 0),
+              'energy': {'CO2': 0, 'Energy': 0}, 'paper': {'Paper': 0}, 'water': {'Water': 0}}
+    for file_path in file_paths:
+        for row in read_rows(file_path, 'Normalization_Factor'):
+            totals['area']['Area'] += row['Gross floor area']
+        mobile_fuel = totals['mobile_fuel']
+        for row in read_rows(file_path, 'Mobile_Fuel'):
+            code, fuel_type = row['Types of Transportation'], row['Fuel Types']
+            data, mileage = row['Fuel Consumption'], row['Distance Travelled during the period/km']
+            mobile_fuel['Fuel kWh'] += data * 9.11
+            mobile_fuel['NOx'] += mileage * factors['NOx Emission' + source + code]
+            mobile_fuel['SOx'] += data * factors['SOx Emission' + source + fuel_type]
+            mobile_fuel['PM'] += mileage * factors['PM Emission' + source + code]
+            mobile_fuel['CO2'] += data * factors['CO2 Emission' + source + fuel_type]
+            mobile_fuel['CH4'] += data * factors['CH4 Emission' + source + code + fuel_type] * 28
+            mobile_fuel['N2O'] += data * factors['N2O Emission' + source + code + fuel_type] * 256
+        for row in read_rows(file_path, 'Energy_Consumption'):
+            totals['energy']['Energy'] += row['Energy Consumption']
+            totals['energy']['CO2'] += row['Energy Consumption'] * factors['Purchased Electricity|' + row['Location']]
+        for row in read_rows(file_path, 'Paper_Usage'):
+            totals['paper']['Paper'] += row['Usage (kg)'] / 1000
+        for row in read_rows(file_path, 'Water_Consumption'):
+            totals['water']['Water'] += row['Water Consumption']
+    return totals
+
+def assert_close_totals(totals, expected, rel):
+    assert list(totals) == list(expected)
+    for category, metrics in expected.items():
+        assert sorted(totals[category]) == sorted(metrics)
+        for metric, value in metrics.items():
+            assert totals[category][metric] == pytest.approx(value, rel=rel), (category, metric)
+
+def test_totals_match_per_row_loops(portfolio):
+    file_paths, emission_factor_file_path, _ = portfolio
+    results = KPIs(file_paths, emission_factor_file_path).calculate()
+    assert_close_totals(results.get_totals(), get_reference_totals(file_paths, emission_factor_file_path), 1e-9)
+    for i, file_path in enumerate(file_paths):
+        site_totals = {category: {metric: float(values[i]) for metric, values in metrics.items()}
+                       for category, metrics in results.site_totals.items()}
+        assert_close_totals(site_totals, get_reference_totals([file_path], emission_factor_file_path), 1e-9)